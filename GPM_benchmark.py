@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+import GPM_download
+import netCDF4
+import numpy as np
+import datetime
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+'''
+GPM_benchmark measures the throughput of GPM_download without access to
+the IMERG archive. It writes synthetic daily files shaped as the IMERG
+ones (48 half-hourly frames of precipitationCal on a global 0.1 degree
+(time, lon, lat) grid, with the archive file names) into a temporary
+directory, then times get_gpm_cubes and gpm_cube_save for every window of
+the given intervals, regions and spans of days, and reports windows per
+second and MB per second read and written.
+
+How to call the script
+GPM_benchmark.py --days 2 --int 1,3,24 --spans 1,2 --backend netcdf4
+
+The regions default to a small box, the Indian Ocean and South East Asia,
+give others with --reg name=E,S,W,N. --resolution 1 makes a coarse grid
+for a quick run, --fixtures keeps the synthetic archive in a directory
+to reuse it, and --out saves the results as JSON to hold later runs against.
+'''
+
+# Regions timed by default, from small to large
+REGIONS=[('small',[88.,0.,98.,10.]),
+         ('IO',[40.,-20.,100.,50.]),
+         ('SEA',[88.,-20.,156.,32.])]
+
+##########################################################################
+#                     MAIN PROGRAM                                       #
+##########################################################################
+def main():
+    '''
+    Makes the synthetic archive and benchmarks the windows on it
+    '''
+    # Parse command line arguments
+    args = parse_args()
+
+    path=args.fixtures or tempfile.mkdtemp(prefix='gpm_benchmark_')
+    try:
+      make_fixtures(path,args.start,args.days,args.product,args.resolution)
+      GPM_download.set_gpm_path(path)
+
+      print_header()
+      results=[]
+      for span in args.spans:
+        for name,region in args.regions or REGIONS:
+          for interval in args.intervals:
+            results.append(benchmark(name,region,interval,span,args))
+            print_result(results[-1])
+
+      if args.fileout:
+        with open(args.fileout,'w') as f:
+          json.dump(results,f,indent=1)
+    finally:
+      if not args.fixtures:
+        shutil.rmtree(path)
+
+##########################################################################
+
+def parse_args():
+  '''Parses and returns command line arguments.'''
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+      description="Benchmark GPM_download on synthetic IMERG files")
+
+  parser.add_argument("--start",
+                      type=lambda day: datetime.datetime.strptime(day,'%Y%m%d'),
+                      help=("First day of the synthetic archive, YYYYmmdd"),
+                      default=datetime.datetime(2020,1,1),
+                      dest="start")
+
+  parser.add_argument("--days",
+                      type=int,
+                      help=("Number of daily files to make"),
+                      default=2,
+                      dest="days")
+
+  parser.add_argument("--int",
+                      type=GPM_download.interval_str_to_list,
+                      help=("Accumulation interval(s) in hours, "
+                            "comma separated"),
+                      default=[1,3,24],
+                      dest="intervals")
+
+  parser.add_argument("--reg",
+                      type=GPM_download.region_arg,
+                      action="append",
+                      help=("Region to time as name=E,S,W,N, repeat it "
+                            "for several. Small, IO and SEA if not given"),
+                      default=None,
+                      dest="regions")
+
+  parser.add_argument("--spans",
+                      type=GPM_download.interval_str_to_list,
+                      help=("Number(s) of days of windows timed, "
+                            "comma separated, shorter than --days"),
+                      default=[1],
+                      dest="spans")
+
+  parser.add_argument("--prod",
+                      type=str,
+                      help=("Product name of the synthetic files"),
+                      default="production",
+                      dest="product")
+
+  parser.add_argument("--backend",
+                      type=str,
+                      choices=["iris","netcdf4"],
+                      help=("Library to read and write NetCDF files"),
+                      default="iris",
+                      dest="backend")
+
+  parser.add_argument("--resolution",
+                      type=float,
+                      help=("Grid spacing of the synthetic files in degrees"),
+                      default=0.1,
+                      dest="resolution")
+
+  parser.add_argument("--fixtures",
+                      type=str,
+                      help=("Directory to keep the synthetic archive in, "
+                            "files already there are reused. A temporary "
+                            "directory removed at the end if not given"),
+                      default=None,
+                      dest="fixtures")
+
+  parser.add_argument("--out",
+                      type=str,
+                      help=("JSON file to save the results"),
+                      default=None,
+                      dest="fileout")
+
+  args = parser.parse_args()
+
+  # Windows closing at midnight take the first frame of the next day
+  if max(args.spans) >= args.days:
+      raise argparse.ArgumentTypeError("--spans must be shorter than --days")
+
+  return args
+
+# make_fixtures
+###################################
+
+def make_fixtures(path,start,days,product,resolution=0.1):
+  '''
+  Writes days synthetic IMERG daily files from start into the archive
+  layout of GPM_download at path, unless they are already there
+  '''
+  for day in range(days):
+    time_i=start + datetime.timedelta(days=day)
+    filename="{0}/{1}/{2:%Y}/gpm_imerg_{1}_{3}_{2:%Y%m%d}.nc".format(path,product,time_i,GPM_download.GPM_V)
+    if not os.path.exists(filename):
+      os.makedirs(os.path.dirname(filename),exist_ok=True)
+      make_day(filename,time_i,resolution,seed=day)
+
+# make_day
+###################################
+
+def make_day(filename,day,resolution=0.1,seed=0):
+  '''
+  Writes a synthetic daily file shaped as the IMERG ones: 48 half-hourly
+  frames of precipitationCal (mm/hr) on a global (time, lon, lat) grid of
+  the given resolution with time bounds. Rain is gamma distributed over
+  about 10% of the points, and missing over the poles as in IMERG
+  '''
+  rng=np.random.RandomState(seed)
+  lats=np.arange(-90.+resolution/2.,90.,resolution).astype('f4')
+  lons=np.arange(-180.+resolution/2.,180.,resolution).astype('f4')
+  fill_value=np.float32(-9999.9)
+
+  with netCDF4.Dataset(filename,'w',format='NETCDF4') as dataset:
+    dataset.createDimension('time',48)
+    dataset.createDimension('lon',len(lons))
+    dataset.createDimension('lat',len(lats))
+    dataset.createDimension('nv',2)
+
+    nc_time=dataset.createVariable('time','i4',('time',))
+    nc_time.units='seconds since 1970-01-01 00:00:00 UTC'
+    nc_time.calendar='julian'
+    nc_time.standard_name='time'
+    nc_time.bounds='time_bnds'
+    start=netCDF4.date2num(day,nc_time.units,nc_time.calendar)
+    nc_time[:]=start+1800*np.arange(48)
+    nc_bnds=dataset.createVariable('time_bnds','i4',('time','nv'))
+    nc_bnds[:,0]=nc_time[:]
+    nc_bnds[:,1]=nc_time[:]+1799
+
+    for name,points,units in (('lon',lons,'degrees_east'),('lat',lats,'degrees_north')):
+      nc_coord=dataset.createVariable(name,'f4',(name,))
+      nc_coord[:]=points
+      nc_coord.units=units
+      nc_coord.standard_name='longitude' if name == 'lon' else 'latitude'
+
+    nc_var=dataset.createVariable('precipitationCal','f4',('time','lon','lat'),
+                                  zlib=True,complevel=1,fill_value=fill_value)
+    nc_var.units='mm/hr'
+    nc_var.long_name='Multi-satellite precipitation estimate with gauge calibration'
+
+    polar=np.abs(lats) > 60.
+    for k in range(48):
+      rain=rng.gamma(0.5,4.,(len(lons),len(lats))).astype('f4')
+      rain[rng.rand(len(lons),len(lats)) > 0.1]=0.
+      nc_var[k]=np.ma.masked_where(np.broadcast_to(polar,rain.shape),rain)
+
+# benchmark
+###################################
+
+def benchmark(name,region,interval,span,args):
+  '''
+  Times get_gpm_cubes and gpm_cube_save for every window of the interval
+  in the first span days of the archive for the region. Returns a
+  dictionary with the times, windows per second and MB read and written
+  per second, read counting every frame of the windows in the region
+  '''
+  path_out=tempfile.mkdtemp(prefix='gpm_benchmark_out_')
+  try:
+    windows=[]
+    time_iter=args.start
+    while time_iter < args.start + datetime.timedelta(days=span):
+      windows.append(time_iter)
+      time_iter=time_iter + datetime.timedelta(hours=interval)
+
+    get_time=0.
+    save_time=0.
+    read_bytes=0
+    written_bytes=0
+    for time_i in windows:
+      start=time.perf_counter()
+      field=GPM_download.get_gpm_cubes(time_i,region,interval,args.product,backend=args.backend)
+      get_time=get_time+time.perf_counter()-start
+
+      start=time.perf_counter()
+      fileout=GPM_download.gpm_cube_save(field,time_i,interval,path_out,args.backend)
+      save_time=save_time+time.perf_counter()-start
+
+      time_f=time_i + datetime.timedelta(hours=interval)
+      frames=len(GPM_download.catalog_frames(time_i,time_f,args.product))
+      read_bytes=read_bytes+frames*field.data.nbytes
+      written_bytes=written_bytes+os.path.getsize(fileout)
+  finally:
+    shutil.rmtree(path_out)
+
+  MB=1024.*1024.
+  return {'region':name,
+          'points':int(field.data.size),
+          'interval':interval,
+          'span':span,
+          'backend':args.backend,
+          'windows':len(windows),
+          'get_s':get_time,
+          'save_s':save_time,
+          'windows_per_s':len(windows)/(get_time+save_time),
+          'read_MB_per_s':read_bytes/MB/get_time,
+          'write_MB_per_s':written_bytes/MB/save_time}
+
+# print_header
+###################################
+
+def print_header():
+  '''
+  Prints the header of the results table
+  '''
+  print(' {:<8s}{:>9s}{:>5s}{:>5s}{:>8s}{:>9s}{:>9s}{:>10s}{:>10s}{:>11s}'.format(
+        'Region','Points','Int','Days','Windows','Get s','Save s','Windows/s','Read MB/s','Write MB/s'))
+
+# print_result
+###################################
+
+def print_result(result):
+  '''
+  Prints a line of the results table
+  '''
+  print(' {region:<8s}{points:>9d}{interval:>5d}{span:>5d}{windows:>8d}{get_s:>9.2f}{save_s:>9.2f}'
+        '{windows_per_s:>10.2f}{read_MB_per_s:>10.1f}{write_MB_per_s:>11.1f}'.format(**result))
+
+#                     END OF PROGRAM                                     #
+##########################################################################
+if __name__ == '__main__':
+    main()
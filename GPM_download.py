@@ -1,10 +1,23 @@
 #!/usr/bin/env python
 
-import iris
+import netCDF4
+import numpy as np
 import datetime
 import os
+import pickle
 import sys
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import json
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
 '''
 This script GPM_download runs fine in Python 3.6.8 version, it needs IRIS v2.2
 library (https://scitools.org.uk/iris/docs/latest/)
@@ -24,6 +37,57 @@ How to call the script
 GPM_download.py  --ini 20200101T0000Z --fin 20200102T0000Z --int 3      \
           --reg 40,-20,100,50 --prod production --dir $HOME/temp/
 
+Several regions can be done in one pass giving them a name, e.g.
+--reg IO=40,-20,100,50 --reg SEA=88,-20,156,32, or listing them in a
+file with --reg-file, one 'name E,S,W,N' per line. Each region is then
+saved in its own subdirectory of --dir.
+
+Several intervals can be done in one pass, e.g. --int 1,3,6,24, each daily
+file is then read once for all of them.
+
+With --output timeseries all windows are appended into a single
+compressed NetCDF4 file per region and interval, GPM_V06B_timeseries.nc,
+instead of one file per window (see --complevel, --pack and --chunks).
+
+Windows done are recorded in GPM_V06B_manifest.json in --dir, with the
+modification time and size of their input files. Re-running skips the
+windows whose inputs have not changed (e.g. NRT files not yet refreshed),
+use --force to redo them all.
+
+The frames of the archive are looked up in GPM_V06B_catalog.json in --dir,
+mapping each half-hourly frame to its daily file and index there. It is
+built as the daily files are first needed and kept up to date from their
+modification time and size, so later runs do not open them to find their
+frames. A window takes its frames from as many daily files as it spans,
+e.g. the 00Z frame closing a window at midnight, or 24h windows from 12Z.
+
+--tile-cache keeps the daily files already read in a local directory as
+compressed tiles of --tile-size degrees, so overlapping regions, e.g.
+the Indian Ocean and South East Asia, are stitched from the tiles cut by
+earlier runs instead of reading the archive again. The tiles least
+recently used are removed once the cache is over --tile-cache-size GB.
+
+For NRT products --follow keeps the script running, polling the archive
+every --poll seconds and doing each window as soon as all its half-hourly
+frames are there, until --fin (or forever if not given). --gpm-path
+reads the daily files from another archive, e.g. a local directory.
+
+With --output cumsum the running sum of the half-hourly frames is stored
+per region in GPM_V06B_cumsum.nc, and the accumulation over any period
+is then taken from it with GPM_query.py, without reading the archive.
+
+With --output stats the windows of each region and interval are reduced
+on the fly to per grid point statistics over the whole period: mean,
+variance, maximum, number of windows at or above --thresholds (e.g. wet
+hours with --int 1) and --percentiles, approximated from a histogram of
+--hist-bins log-spaced bins. They are saved at the end of the run in
+GPM_V06B_stats_<ini>_<fin>.nc, memory does not grow with the period.
+
+--profile report.json (or report.csv) records the wall time, data read
+and written, peak memory traced by tracemalloc and peak RSS of every
+stage (load, cut, average, save/write, manifest, close) per day, region
+and window, and prints a summary table per stage at the end of the run.
+
 ############ Examples of regions:
 
 Indian Ocean:       40, -20, 100, 50
@@ -51,13 +115,16 @@ Needs registering
 
 ############ CHANGES NEEDED FOR NON-MET OFFICE SITES
 
-To use outside Met Office, change gpm_path variable at L21 accordingly
-and the filenames (if different) at L118.
+To use outside Met Office, change the path_gpm variable (or call
+set_gpm_path) accordingly and the filenames (if different) in gpm_filename.
 
-To employ another library to load, time-average and save netcdf files 
-than IRIS, like xarray or netCDF4. Change L197-203 to read the 
-required temporal fields and average over time. 
-Then change L238 to save output files.
+Files are read and saved with IRIS by default. --backend netcdf4 uses
+the netCDF4 library and NumPy instead, without the start-up cost of
+importing IRIS. To employ another library, like xarray, add a load and
+save function to BACKENDS, reading the region and a slice of the frames
+of a daily file into a GPMField and saving a GPMField window respectively.
+Both backends save the windows in the dimension order of the daily files,
+(lon, lat) for the IMERG ones, with double precision coordinates.
 
 Any issues contact Claudio Sanchez (claudio.sanchez@metoffice.gov.uk)
 '''
@@ -70,6 +137,19 @@ GPM_V='V06B'
 ## GPM Path
 path_gpm='/project/earthobs/PRECIPITATION/GPM/netcdf/imerg/'
 
+# Serialises NetCDF library calls, which are not thread-safe, across the
+# request threads of GPM_server.py
+netcdf_lock=threading.RLock()
+
+# Local cache of daily file tiles, see set_tile_cache
+tile_cache_dir=None
+tile_cache_size=10.
+tile_size=10.
+
+# Stages recorded with --profile, see profile_stage
+profiling=False
+profile_records=[]
+
 ##########################################################################
 #                     MAIN PROGRAM, ITERATE THROUGH TIME                 #
 ##########################################################################
@@ -82,24 +162,46 @@ def main():
     args = parse_args()
     
     #Check arguments
-    check_args(args.interval,args.region,args.product)
-
-    #Time iter to loop from init_time to final_time
-    time_iter=args.init_time
-
-    while time_iter <= args.final_time:
-      # Define end of acc interval
-      time_iter_top=time_iter + datetime.timedelta(hours=args.interval)
-
-      print( 'Doing {:%HZ %d/%m/%Y} to {:%HZ %d/%m/%Y}'.format(time_iter,time_iter_top))
-      #Get cubes
-      cube=get_gpm_cubes(time_iter,args.region,args.interval,args.product)
-
-      #Save cube
-      gpm_cube_save(cube,time_iter,args.interval,args.path_out)
-
-      #Iterate to next time
-      time_iter=time_iter_top
+    check_args(args.intervals,args.regions,args.product)
+
+    #Read the GPM files from the chosen archive
+    set_gpm_path(args.gpm_path)
+    set_tile_cache(args.tile_cache,args.tile_cache_size,args.tile_size)
+    set_profile(args.profile is not None)
+
+    #Windows already done, the manifest and timeseries output are only
+    #written here, never by the workers
+    manifest=read_manifest(args.path_out)
+    read_catalog(args.path_out)
+    datasets={}
+
+    pool=None
+    if args.workers > 1:
+      pool=concurrent.futures.ProcessPoolExecutor(max_workers=args.workers)
+
+    if args.follow:
+      failed=follow(args,manifest,datasets,pool)
+    else:
+      failed,pending=process_windows(args,args.final_time,manifest,datasets,pool)
+
+    if pool is not None:
+      pool.shutdown()
+    with netcdf_lock:
+      for fileout,dataset in datasets.items():
+        with profile_stage('close',fileout):
+          dataset.close()
+
+    #Report the time and memory of each stage
+    if args.profile:
+      write_profile(profile_records,args.profile)
+      print_profile(profile_records)
+
+    #Report windows that could not be done
+    if failed:
+      print(' {:d} window(s) failed:'.format(len(failed)))
+      for name,time_iter,interval,error in failed:
+        print('   {:s} {:%HZ %d/%m/%Y} {:d}h: {:s}'.format(name,time_iter,interval,error))
+      sys.exit(1)
 
 ##########################################################################
 
@@ -125,17 +227,27 @@ def parse_args():
                       dest="final_time")
 
   parser.add_argument("--int",
-                      type=int,
-                      help=("Accumulation interval in hours"),
-                      default=True,
-                      dest="interval")
+                      type=interval_str_to_list,
+                      help=("Accumulation interval(s) in hours, "
+                            "several comma separated e.g. 1,3,6,24"),
+                      default=None,
+                      dest="intervals")
 
   parser.add_argument("--reg",
-                      type=region_str_to_list,
-                      help=("Region to extract in"
-                            "E,S,W,N coordinates"),
-                      default=True,
-                      dest="region")
+                      type=region_arg,
+                      action="append",
+                      help=("Region to extract in "
+                            "E,S,W,N coordinates, or name=E,S,W,N. "
+                            "Repeat it for several regions"),
+                      default=None,
+                      dest="regions")
+
+  parser.add_argument("--reg-file",
+                      type=str,
+                      help=("File with one 'name E,S,W,N' "
+                            "region per line"),
+                      default=None,
+                      dest="region_file")
 
   parser.add_argument("--prod",
                       type=str,
@@ -143,6 +255,146 @@ def parse_args():
                       default=True,
                       dest="product")
 
+  parser.add_argument("--workers",
+                      type=int,
+                      help=("Number of processes, days are "
+                            "spread across them"),
+                      default=1,
+                      dest="workers")
+
+  parser.add_argument("--output",
+                      type=str,
+                      choices=["files","timeseries","cumsum","stats"],
+                      help=("'files' saves one NetCDF per window, "
+                            "'timeseries' appends all windows into one "
+                            "chunked NetCDF4 file per region and interval, "
+                            "'cumsum' stores the running sum of the "
+                            "half-hourly frames per region (see GPM_query.py), "
+                            "'stats' saves statistics of the windows over "
+                            "the period per region and interval"),
+                      default="files",
+                      dest="output")
+
+  parser.add_argument("--complevel",
+                      type=int,
+                      help=("zlib compression level of timeseries "
+                            "output, 0 to disable"),
+                      default=4,
+                      dest="complevel")
+
+  parser.add_argument("--no-shuffle",
+                      action="store_false",
+                      help=("Disable the shuffle filter of timeseries output"),
+                      dest="shuffle")
+
+  parser.add_argument("--pack",
+                      type=float,
+                      help=("Store timeseries output as int16 packed "
+                            "with this scale factor (mm/hr), e.g. 0.01"),
+                      default=None,
+                      dest="pack_scale")
+
+  parser.add_argument("--chunks",
+                      type=chunks_str_to_list,
+                      help=("Chunk shape time,lat,lon of timeseries output. "
+                            "A row of chunks in time, those of the whole "
+                            "region, is kept in memory while writing"),
+                      default=[24,64,64],
+                      dest="chunks")
+
+  parser.add_argument("--thresholds",
+                      type=float_str_to_list,
+                      help=("Rain rates (mm/hr) whose exceedances are "
+                            "counted in stats output, comma separated"),
+                      default=[0.1,1.,10.],
+                      dest="thresholds")
+
+  parser.add_argument("--percentiles",
+                      type=float_str_to_list,
+                      help=("Percentiles saved in stats output, "
+                            "comma separated"),
+                      default=[50.,90.,95.,99.],
+                      dest="percentiles")
+
+  parser.add_argument("--hist-bins",
+                      type=int,
+                      help=("Number of histogram bins the percentiles "
+                            "of stats output are taken from, more are "
+                            "finer and take more memory"),
+                      default=50,
+                      dest="hist_bins")
+
+  parser.add_argument("--force",
+                      action="store_true",
+                      help=("Redo all windows, even those up to date "
+                            "in the output manifest"),
+                      dest="force")
+
+  parser.add_argument("--prefetch",
+                      type=int,
+                      help=("Number of days read ahead in a separate "
+                            "process while the current one is averaged and "
+                            "saved, 0 to disable. Used without --workers"),
+                      default=0,
+                      dest="prefetch")
+
+  parser.add_argument("--follow",
+                      action="store_true",
+                      help=("Keep running, polling the archive and doing "
+                            "each window as soon as all its frames are "
+                            "there. Runs until --fin, forever if not given"),
+                      dest="follow")
+
+  parser.add_argument("--poll",
+                      type=float,
+                      help=("Seconds between polls of the archive in --follow"),
+                      default=30.,
+                      dest="poll")
+
+  parser.add_argument("--backend",
+                      type=str,
+                      choices=["iris","netcdf4"],
+                      help=("Library to read and write NetCDF files, "
+                            "netcdf4 avoids the start-up cost of Iris"),
+                      default="iris",
+                      dest="backend")
+
+  parser.add_argument("--gpm-path",
+                      type=str,
+                      help=("Archive of daily IMERG files"),
+                      default=path_gpm,
+                      dest="gpm_path")
+
+  parser.add_argument("--profile",
+                      type=str,
+                      help=("Report file with the time, data read and "
+                            "written and memory of each stage, CSV if it "
+                            "ends in .csv, JSON otherwise. Tracing memory "
+                            "slows the run down"),
+                      default=None,
+                      dest="profile")
+
+  parser.add_argument("--tile-cache",
+                      type=str,
+                      help=("Local directory to cache the daily files "
+                            "read as tiles, reused by later runs for "
+                            "overlapping regions"),
+                      default=None,
+                      dest="tile_cache")
+
+  parser.add_argument("--tile-cache-size",
+                      type=float,
+                      help=("Size of the tile cache in GB, the tiles "
+                            "least recently used are removed beyond it"),
+                      default=10.,
+                      dest="tile_cache_size")
+
+  parser.add_argument("--tile-size",
+                      type=float,
+                      help=("Size of the cached tiles in degrees"),
+                      default=10.,
+                      dest="tile_size")
+
   parser.add_argument("--dir",
                       type=str,
                       help=("Output directory, if None it will "
@@ -158,15 +410,26 @@ def parse_args():
       raise argparse.ArgumentTypeError("Must supply Init time in YYYYmmddTHHMMZ "
                                        "format in --ini")
 
-  if not args.final_time:
+  # Follow mode may run without end
+  if args.follow and args.final_time is True:
+      args.final_time=None
+  elif not args.final_time:
       raise argparse.ArgumentTypeError("Must supply Final time in YYYYmmddTHHMMZ "
                                        "format in --fin")
 
-  if not args.interval:
+  if not args.intervals:
       raise argparse.ArgumentTypeError("Must supply acc internval in hours "
                                        "in --int arg")
 
-  if not args.region:
+  # Statistics are saved once all windows are done
+  if args.follow and args.output == 'stats':
+      raise argparse.ArgumentTypeError("--output stats can not be used with --follow")
+
+  # Regions from file are added to those in --reg
+  if args.region_file:
+      args.regions=(args.regions or [])+read_region_file(args.region_file)
+
+  if not args.regions:
       raise argparse.ArgumentTypeError("Must supply region as E,S,W,N coords")
 
   if not args.product:
@@ -201,23 +464,104 @@ def region_str_to_list(region):
 
   return region_list
 
+# region_arg
+###################################
+
+
+def region_arg(region):
+  '''
+  Converts a region argument, E,S,W,N or name=E,S,W,N, into a
+  (name, region list) tuple. Unnamed regions get an empty name
+  '''
+  name=''
+  if '=' in region:
+    name,region=region.split('=',1)
+
+  return name.strip(),region_str_to_list(region)
+
+# read_region_file
+###################################
+
+
+def read_region_file(filename):
+  '''
+  Reads a regions file with one region per line given as
+  'name E,S,W,N' or 'name=E,S,W,N'. Lines starting with # are skipped
+  '''
+  regions=[]
+  with open(filename,'r') as f:
+    for line in f:
+      line=line.split('#')[0].strip()
+      if not line:
+        continue
+      if '=' not in line:
+        line='='.join(line.rsplit(None,1))
+      regions.append(region_arg(line))
+
+  return regions
+
+# interval_str_to_list
+###################################
+
+
+def interval_str_to_list(interval):
+  '''
+  Converts a string with comma separated intervals into a sorted list
+  '''
+  interval_list=sorted(set(int(i) for i in interval.split(',')))
+
+  return interval_list
+
+# float_str_to_list
+###################################
+
+
+def float_str_to_list(values):
+  '''
+  Converts a string with comma separated numbers into a sorted list
+  '''
+  value_list=sorted(set(float(i) for i in values.split(',')))
+
+  return value_list
+
+# chunks_str_to_list
+###################################
+
+
+def chunks_str_to_list(chunks):
+  '''
+  Converts a string with time,lat,lon chunk sizes into a list
+  '''
+  chunk_list=[int(i) for i in chunks.split(',')]
+  if len(chunk_list) != 3:
+      raise argparse.ArgumentTypeError("Chunks must be given as time,lat,lon")
+
+  return chunk_list
+
 # check_args
 ###################################
 
-def check_args(interval,region,product):
+def check_args(intervals,regions,product):
 
-  # Check interval is within predefined values
-  if interval not in [1,3,6,24]:
+  # Check intervals are within predefined values
+  for interval in intervals:
+    if interval not in [1,3,6,24]:
       raise argparse.ArgumentTypeError("Interval available options: 1,3,6,24 "
                                        "in --int arg.")
-  # Check region 
-  if len(region) !=4:
+  # Check regions, several of them need different names for their output dirs
+  names=[name for name,region in regions]
+  if len(regions) > 1 and ('' in names or len(set(names)) != len(names)):
+      raise argparse.ArgumentTypeError("Several regions must be given unique names "
+                                       "as name=E,S,W,N in --reg")
+
+  for name,region in regions:
+    if len(region) !=4:
       raise argparse.ArgumentTypeError("Region must be a list of E,S,W,N e.g. "
                                       "40,-20,100,50 for the Indian Ocean")
-  if region[0]>region[2]:
+    if region[0]>region[2]:
       raise argparse.ArgumentTypeError("E coord must be lower than W in --reg ")
 
-  if region[1]>region[3]:
+    if region[1]>region[3]:
       raise argparse.ArgumentTypeError("S coord must be lower than N in --reg")
 
   # Check Product
@@ -225,45 +569,1055 @@ def check_args(interval,region,product):
       raise argparse.ArgumentTypeError("Not recognized GPM-IMERG product in --prod "
                                        "It must be: 'production','NRTLate' or 'NRTearly' ")
 
-# get_gpm_cubes
+# get_day_windows
+###################################
+
+def get_day_windows(init_time,final_time,intervals):
+  '''
+  Returns the accumulation windows from init_time to final_time for
+  every interval, as (start time, interval) pairs sorted in time and
+  grouped in one list per day
+  '''
+  windows=[]
+  for interval in intervals:
+    time_iter=init_time
+    while time_iter <= final_time:
+      windows.append((time_iter,interval))
+      time_iter=time_iter + datetime.timedelta(hours=interval)
+
+  day_windows=[]
+  for time_iter,interval in sorted(windows):
+    if not day_windows or day_windows[-1][0][0].date() != time_iter.date():
+      day_windows.append([])
+    day_windows[-1].append((time_iter,interval))
+
+  return day_windows
+
+# process_day
+###################################
+
+def process_day(windows,sources,args,union_field=None):
+  '''
+  Loads the frames of the day once, from the (file, first, last index)
+  sources spanning its windows (see catalog_sources), for the bounding
+  box of all the regions, and computes the given (region name, window,
+  interval) of that day. The day may be given already read (or the
+  exception raised reading it) as union_field, see prefetch_days.
+  Windows are saved to args.path_out, in a subdirectory for named regions,
+  or returned to be appended by the caller in timeseries output mode.
+  Returns the list of (region name, window, interval, field or None) done,
+  a list of (region name, window, interval, error message) for those
+  that failed, so a missing file or a bad window does not abort the run,
+  and the stages recorded with --profile
+  '''
+  #Workers may not share the globals of the main process
+  set_gpm_path(args.gpm_path)
+  set_tile_cache(args.tile_cache,args.tile_cache_size,args.tile_size)
+  set_profile(args.profile is not None)
+
+  names=set(name for name,time_iter,interval in windows)
+  regions=[(name,region) for name,region in args.regions if name in names]
+  done=[]
+  failed=[]
+
+  try:
+    if union_field is None:
+      union_field=load_day_union(windows,sources,args)
+    elif isinstance(union_field,Exception):
+      raise union_field
+  except Exception as exc:
+    return done,[window+(str(exc),) for window in windows],take_profile_records()
+
+  for name,region in regions:
+    region_windows=[(time_iter,interval) for window_name,time_iter,interval in windows
+                    if window_name == name]
+    try:
+      #Cut the region from the day in memory
+      if len(regions) > 1:
+        with profile_stage('cut',name,union_field.times[0]):
+          day_field=cut_region(union_field,region)
+      else:
+        day_field=union_field
+      if args.output == 'cumsum':
+        fields=dict((window,day_field) for window in region_windows)
+      else:
+        with profile_stage('average',name,union_field.times[0]):
+          fields=get_gpm_windows(day_field,region_windows)
+    except Exception as exc:
+      failed.extend([(name,time_iter,interval,str(exc)) for time_iter,interval in region_windows])
+      continue
+
+    for time_iter,interval in region_windows:
+      # Define end of acc interval
+      time_iter_top=time_iter + datetime.timedelta(hours=interval)
+      print( 'Doing {:s}{:%HZ %d/%m/%Y} to {:%HZ %d/%m/%Y}'.format(name+' ' if name else '',time_iter,time_iter_top))
+      if args.output in ('timeseries','cumsum','stats'):
+        done.append((name,time_iter,interval,fields[(time_iter,interval)]))
+        continue
+      try:
+        #Save field
+        with profile_stage('save',name,time_iter,interval) as record:
+          fileout=gpm_cube_save(fields[(time_iter,interval)],time_iter,interval,os.path.join(args.path_out,name),args.backend)
+          record['bytes_written']=os.path.getsize(fileout)
+        done.append((name,time_iter,interval,None))
+      except Exception as exc:
+        failed.append((name,time_iter,interval,str(exc)))
+
+  return done,failed,take_profile_records()
+
+# load_day_union
+###################################
+
+def load_day_union(windows,sources,args):
+  '''
+  Loads the frames of the sources of the given (region name, window,
+  interval) for the bounding box of their regions
+  '''
+  names=set(name for name,time_iter,interval in windows)
+  regions=[(name,region) for name,region in args.regions if name in names]
+
+  with profile_stage('load','',windows[0][1]) as record:
+    union_field=load_gpm_frames(sources,union_region(regions),args.backend)
+    record['bytes_read']=union_field.data.nbytes
+
+  return union_field
+
+# prefetch_days
 ###################################
 
-def get_gpm_cubes(time_i,region,interval,product):
+def prefetch_days(day_todo,args):
   '''
-  Load rainfall accumulation fields using a lambda function over the selected time
-  then cut-off the region of interest and averages over time
+  Reads the (windows, sources) days of day_todo in a separate process, up
+  to args.prefetch days ahead, while the caller averages and saves the
+  current one. Yields each day windows and sources with its field, or the
+  exception raised reading it. The reader has its own NetCDF library, so
+  reading the next days overlaps writing the current one
+  '''
+  reader=concurrent.futures.ProcessPoolExecutor(max_workers=1)
+  futures=collections.deque()
+
+  def prefetched():
+    todo,sources,future=futures.popleft()
+    union_field,records=future.result()
+    profile_records.extend(records)
+    return todo,sources,union_field
+
+  try:
+    for todo,sources in day_todo:
+      futures.append((todo,sources,reader.submit(prefetch_day,todo,sources,args)))
+      # The day yielded and at most args.prefetch days read ahead of it
+      if len(futures) > args.prefetch:
+        yield prefetched()
+    while futures:
+      yield prefetched()
+  finally:
+    reader.shutdown()
+
+# prefetch_day
+###################################
+
+def prefetch_day(windows,sources,args):
   '''
+  Reads a day in the process of prefetch_days. Returns its field, or the
+  exception raised reading it, and the stages recorded
+  '''
+  #The reader may not share the globals of the main process
+  set_gpm_path(args.gpm_path)
+  set_tile_cache(args.tile_cache,args.tile_cache_size,args.tile_size)
+  set_profile(args.profile is not None)
+
+  try:
+    union_field=load_day_union(windows,sources,args)
+  except Exception as exc:
+    union_field=exc
+
+  return union_field,take_profile_records()
+
+# finish_day
+###################################
+
+def finish_day(result,args,manifest,datasets):
+  '''
+  Takes the (done, failed, profile) result of process_day, appends the windows to
+  their timeseries files in timeseries output mode, the day frames to
+  the cumulative sum store in cumsum mode, or adds the windows to their
+  statistics in stats mode (datasets keeps the files and statistics open
+  during the run), and records the windows done in the manifest.
+  Returns the windows that failed as process_day does
+  '''
+  done,failed,records=result
+  regions=dict(args.regions)
+  profile_records.extend(records)
+
+  for name,time_iter,interval,field in done:
+    path_out=os.path.join(args.path_out,name)
+    try:
+      if field is not None:
+        with profile_stage('write',name,time_iter,interval) as record:
+          if args.output == 'cumsum':
+            with netcdf_lock:
+              fileout=gpm_cumsum_save(field,path_out,args,datasets)
+          elif args.output == 'stats':
+            gpm_stats_add(field,interval,path_out,args,datasets)
+          else:
+            with netcdf_lock:
+              fileout=gpm_timeseries_save(field,interval,path_out,args,datasets)
+          record['bytes_written']=field.data.nbytes
+      else:
+        fileout=gpm_out_file(time_iter,interval,path_out)
+    except Exception as exc:
+      failed.append((name,time_iter,interval,str(exc)))
+      continue
+    # Statistics are only complete at the end, windows are not recorded
+    if args.output != 'stats':
+      manifest[manifest_key(name,time_iter,interval)]=manifest_record(regions[name],time_iter,interval,fileout,args)
+
+  # Flush timeseries before recording them, so the manifest never gets ahead
+  with profile_stage('manifest'):
+    with netcdf_lock:
+      for dataset in datasets.values():
+        dataset.sync()
+    write_manifest(manifest,args.path_out)
+
+  return failed
+
+# process_windows
+###################################
+
+def process_windows(args,final_time,manifest,datasets,pool=None):
+  '''
+  Processes the windows from args.init_time to final_time not yet done
+  according to the manifest, day by day and spread across pool if given.
+  In follow mode windows whose frames are not all in the archive yet are
+  left pending. Returns the windows that failed, as process_day does, and
+  the number of windows pending
+  '''
+  #Windows from init_time to final_time, grouped by day. The cumulative
+  #sum store takes whole days
+  if args.output == 'cumsum':
+    init_time=datetime.datetime.combine(args.init_time.date(),datetime.time())
+    day_windows=get_day_windows(init_time,final_time,[24])
+  else:
+    day_windows=get_day_windows(args.init_time,final_time,args.intervals)
+  if not day_windows:
+    return [],0
+
+  #Catalog the frames of the daily files the windows span
+  last_time=max(time_iter+datetime.timedelta(hours=interval) for time_iter,interval in day_windows[-1])
+  if update_catalog(day_windows[0][0][0],last_time,args.product):
+    write_catalog(args.path_out)
+
+  #Skip the windows of each region already done from the same inputs
+  day_todo=[]
+  failed=[]
+  skipped=0
+  pending=0
+  for windows in day_windows:
+    todo=[]
+    for time_iter,interval in windows:
+      if args.follow and not window_complete(time_iter,interval,args.product):
+        pending=pending+len(args.regions)
+        continue
+      # Check if production has got time requested (may be too close to real time!)
+      missing=window_missing(time_iter,interval,args.product)
+      if args.product == 'production' and missing:
+        failed.extend([(name,time_iter,interval,"File {:s} not found. Production has not reached "
+                        "this date".format(missing[0])) for name,region in args.regions])
+        continue
+      for name,region in args.regions:
+        #Statistics take every window of the period
+        if not args.force and args.output != 'stats' and window_up_to_date(manifest,name,region,time_iter,interval,args):
+          skipped=skipped+1
+        else:
+          todo.append((name,time_iter,interval))
+    if todo:
+      #Frames spanning the windows to do, only those of the day itself for
+      #the cumulative sum store
+      time_a=min(time_iter for name,time_iter,interval in todo)
+      time_b=max(time_iter+datetime.timedelta(hours=interval) for name,time_iter,interval in todo)
+      sources=catalog_sources(time_a,time_b,args.product,closed=args.output != 'cumsum')
+      day_todo.append((todo,sources))
+  if skipped and not args.follow:
+    print(' Skipping {:d} window(s) already done, see {:s}'.format(skipped,manifest_filename(args.path_out)))
+
+  #Process days, each returns the windows done and those that failed
+  if pool is not None:
+    #At most two days per worker in flight, each dropped once written so
+    #the fields of the days done are not kept
+    futures=collections.deque()
+    for todo,sources in day_todo:
+      futures.append(pool.submit(process_day,todo,sources,args))
+      if len(futures) >= 2*args.workers:
+        failed.extend(finish_day(futures.popleft().result(),args,manifest,datasets))
+    while futures:
+      failed.extend(finish_day(futures.popleft().result(),args,manifest,datasets))
+  elif args.prefetch > 0:
+    for todo,sources,union_field in prefetch_days(day_todo,args):
+      failed.extend(finish_day(process_day(todo,sources,args,union_field),args,manifest,datasets))
+  else:
+    for todo,sources in day_todo:
+      failed.extend(finish_day(process_day(todo,sources,args),args,manifest,datasets))
+
+  return failed,pending
+
+# follow
+###################################
+
+def follow(args,manifest,datasets,pool=None):
+  '''
+  Polls the archive every args.poll seconds and processes each window as
+  soon as all its half-hourly frames have arrived. Windows already done
+  are skipped through the manifest, and redone if their files are
+  refreshed. Stops once args.final_time is reached with nothing pending,
+  runs forever if it is None. Returns the windows failing at the last poll
+  '''
+  while True:
+    now=datetime.datetime.utcnow()
+    final_time=now if args.final_time is None else min(now,args.final_time)
+
+    failed,pending=process_windows(args,final_time,manifest,datasets,pool)
+    for name,time_iter,interval,error in failed:
+      print(' Failed {:s}{:%HZ %d/%m/%Y} {:d}h: {:s}'.format(name+' ' if name else '',time_iter,interval,error))
+
+    if args.final_time is not None and now >= args.final_time and pending == 0:
+      return failed
+
+    time.sleep(args.poll)
+
+# window_complete
+###################################
+
+def window_complete(time_i,interval,product):
+  '''
+  True if all the half-hourly frames of the window, time_i <= time <= time_f
+  as get_gpm_cubes takes them, are in the catalog of the archive
+  '''
+  time_f=time_i + datetime.timedelta(hours=interval)
+  frames=set(frame for frame,filename,index in catalog_frames(time_i,time_f,product))
 
-  # Define path to extract data
-  filename="{0}/{1}/{2:%Y}/gpm_imerg_{1}_{3}_{2:%Y%m%d}.nc".format(path_gpm,product,time_i,GPM_V)
+  frame=time_i
+  while frame <= time_f:
+    if frame not in frames:
+      return False
+    frame=frame+datetime.timedelta(minutes=30)
 
-  # Check if production has got time requested (may be too close to real time!)
-  if product=='production' and not os.path.exists(filename):
-    print(" File {:s} not found. Production has not reached this date".format(filename))
-    sys.exit(1)
+  return True
 
-  #Get time constraint
+# window_missing
+###################################
+
+def window_missing(time_i,interval,product):
+  '''
+  Returns the daily files spanned by the window that are not in the
+  catalog of the archive
+  '''
   time_f=time_i + datetime.timedelta(hours=interval)
-  cons_time=iris.Constraint(time=lambda cell: time_i <= cell.point <= time_f)
-  # Get cubes
-  gpm=iris.load_cube(filename,cons_time)
-  #Extract
-  gpm=gpm.intersection(longitude=[region[0],region[2]],latitude=[region[1],region[3]])
-  #Average on time
-  gpm=gpm.collapsed('time',iris.analysis.MEAN)
 
-  return gpm
+  return [filename for filename in catalog_days(time_i,time_f,product)
+          if filename not in _catalog]
+
+# file_frame_times
+###################################
+
+def file_frame_times(filename):
+  '''
+  Returns the frame times in a daily file, in the order of the file, read
+  with netCDF4
+  '''
+  with netcdf_lock, netCDF4.Dataset(filename,'r') as dataset:
+    nc_time=dataset.variables['time']
+    dates=netCDF4.num2date(nc_time[:],nc_time.units,getattr(nc_time,'calendar','standard'))
+
+  return [datetime.datetime(*d.timetuple()[:6]) for d in dates]
+
+# catalog_filename
+###################################
+
+# Frames of the daily files, {filename: {'mtime','size','times'}}
+_catalog={}
+
+def catalog_filename(path_out):
+  '''
+  Returns the catalog file of the archive frames, next to the manifest
+  '''
+  return os.path.join(path_out,'GPM_'+GPM_V+'_catalog.json')
+
+# read_catalog
+###################################
+
+def read_catalog(path_out):
+  '''
+  Reads the catalog of the frames of the daily files saved at path_out,
+  frame times are stored in minutes since 1970
+  '''
+  _catalog.clear()
+  filename=catalog_filename(path_out)
+  if not os.path.exists(filename):
+    return
+
+  epoch=datetime.datetime(1970,1,1)
+  with open(filename,'r') as f:
+    for name,entry in json.load(f).items():
+      _catalog[name]={'mtime':entry['mtime'],
+                      'size':entry['size'],
+                      'times':[epoch+datetime.timedelta(minutes=t) for t in entry['times']]}
+
+# write_catalog
+###################################
+
+def write_catalog(path_out):
+  '''
+  Writes the catalog atomically at path_out
+  '''
+  filename=catalog_filename(path_out)
+  if not os.path.exists(path_out):
+    os.makedirs(path_out,exist_ok=True)
+
+  epoch=datetime.datetime(1970,1,1)
+  catalog={}
+  for name,entry in _catalog.items():
+    catalog[name]={'mtime':entry['mtime'],
+                   'size':entry['size'],
+                   'times':[int((t-epoch).total_seconds()//60) for t in entry['times']]}
+
+  with open(filename+'.tmp','w') as f:
+    json.dump(catalog,f)
+  os.replace(filename+'.tmp',filename)
+
+# update_catalog
+###################################
+
+def update_catalog(time_a,time_b,product):
+  '''
+  Brings the catalog up to date for the daily files from time_a to time_b.
+  Each file is only opened to read its frame times when it is new or its
+  modification time or size have changed. Returns True if the catalog changed
+  '''
+  changed=False
+  for filename in catalog_days(time_a,time_b,product):
+    try:
+      stat=os.stat(filename)
+    except FileNotFoundError:
+      if _catalog.pop(filename,None) is not None:
+        changed=True
+      continue
+
+    entry=_catalog.get(filename)
+    if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+      _catalog[filename]={'mtime':stat.st_mtime,
+                          'size':stat.st_size,
+                          'times':file_frame_times(filename)}
+      changed=True
+
+  return changed
+
+# catalog_days
+###################################
+
+def catalog_days(time_a,time_b,product):
+  '''
+  Returns the daily files from the day of time_a to that of time_b
+  '''
+  day=datetime.datetime.combine(time_a.date(),datetime.time())
+  filenames=[]
+  while day <= time_b:
+    filenames.append(gpm_filename(day,product))
+    day=day+datetime.timedelta(days=1)
+
+  return filenames
+
+# catalog_frames
+###################################
+
+def catalog_frames(time_a,time_b,product,closed=True):
+  '''
+  Returns the sorted (time, daily file, index in the file) of the frames
+  time_a <= time <= time_b in the catalog, time < time_b if not closed
+  '''
+  frames=[]
+  for filename in catalog_days(time_a,time_b,product):
+    if filename not in _catalog:
+      continue
+    for index,frame in enumerate(_catalog[filename]['times']):
+      if time_a <= frame and (frame < time_b or closed and frame == time_b):
+        frames.append((frame,filename,index))
+
+  return sorted(frames)
+
+# catalog_sources
+###################################
+
+def catalog_sources(time_a,time_b,product,closed=True):
+  '''
+  Returns the frames from time_a to time_b in the catalog as the fewest
+  (daily file, first index, last index) slices to read, in time order
+  '''
+  sources=[]
+  for frame,filename,index in catalog_frames(time_a,time_b,product,closed):
+    if sources and sources[-1][0] == filename and sources[-1][2] == index-1:
+      sources[-1]=(filename,sources[-1][1],index)
+    else:
+      sources.append((filename,index,index))
+
+  return sources
+
+# union_region
+###################################
+
+def union_region(regions):
+  '''
+  Returns the E,S,W,N bounding box of all the regions, so the daily file
+  is read once for all of them
+  '''
+  boxes=[region for name,region in regions]
+  union=[min(box[0] for box in boxes),min(box[1] for box in boxes),
+         max(box[2] for box in boxes),max(box[3] for box in boxes)]
+  # Do not go around the globe more than once
+  union[2]=min(union[2],union[0]+360.)
+
+  return union
+
+# set_gpm_path
+###################################
+
+def set_gpm_path(path):
+  '''
+  Sets the archive of daily IMERG files
+  '''
+  global path_gpm
+  path_gpm=path
+
+# set_tile_cache
+###################################
+
+def set_tile_cache(path,size,degrees):
+  '''
+  Sets the directory of the tile cache (None to read the daily files
+  directly), its size in GB and the size of the tiles in degrees
+  '''
+  global tile_cache_dir,tile_cache_size,tile_size
+  tile_cache_dir=path
+  tile_cache_size=size
+  tile_size=degrees
+
+# gpm_filename
+###################################
+
+def gpm_filename(time_i,product):
+  '''
+  Returns the path of the daily IMERG file containing time_i
+  '''
+  return "{0}/{1}/{2:%Y}/gpm_imerg_{1}_{3}_{2:%Y%m%d}.nc".format(path_gpm,product,time_i,GPM_V)
+
+# GPMField
+###################################
+
+class GPMField(object):
+  '''
+  Rainfall of a region as the backends read and write it. data is a
+  masked array of half-hourly frames (time, lat, lon), or (lat, lon) for
+  an averaged window, times the frame times as datetimes, time_bounds
+  their (start, end) or None, lats and lons the grid points, lat_bounds
+  and lon_bounds their bounds or None, and meta a dictionary with the
+  names and units of the variable and coordinates to write them back,
+  lon_first True when the files have longitude before latitude as the
+  raw IMERG ones (time, lon, lat), so windows are saved in that order
+  '''
+  def __init__(self,data,times,lats,lons,time_bounds=None,lat_bounds=None,
+               lon_bounds=None,meta=None):
+    self.data=np.ma.asarray(data)
+    self.times=list(times)
+    self.time_bounds=time_bounds
+    self.lats=np.asarray(lats)
+    self.lons=np.asarray(lons)
+    self.lat_bounds=lat_bounds
+    self.lon_bounds=lon_bounds
+    self.meta=meta
+
+# load_gpm_frames
+###################################
+
+def load_gpm_frames(sources,region,backend='iris'):
+  '''
+  Load the (daily file, first index, last index) sources of a day once
+  (see catalog_sources), cut-off the region of interest and keep their
+  half-hourly frames in memory, so every accumulation window of the day
+  can be taken from the same array. Returns a GPMField read with the
+  given backend, 'iris' or 'netcdf4'
+  '''
+  if not sources:
+    raise FileNotFoundError("No GPM files found for the windows requested")
+
+  # Only the lat/lon hyperslab of the region and the frames are read from disk
+  fields=[]
+  with netcdf_lock:
+    for filename,first,last in sources:
+      if tile_cache_dir:
+        fields.append(load_tiles(filename,region,slice(first,last+1),backend))
+      else:
+        fields.append(BACKENDS[backend]['load'](filename,region,slice(first,last+1)))
+
+  if len(fields) == 1:
+    return fields[0]
+
+  field=fields[0]
+  time_bounds=None
+  if all(piece.time_bounds is not None for piece in fields):
+    time_bounds=[bounds for piece in fields for bounds in piece.time_bounds]
+
+  return GPMField(np.ma.concatenate([piece.data for piece in fields],axis=0),
+                  [frame for piece in fields for frame in piece.times],
+                  field.lats,
+                  field.lons,
+                  time_bounds=time_bounds,
+                  lat_bounds=field.lat_bounds,
+                  lon_bounds=field.lon_bounds,
+                  meta=field.meta)
+
+# load_tiles
+###################################
+
+def load_tiles(filename,region,frames,backend='iris'):
+  '''
+  Reads the region and the frames of a daily file as load_gpm_frames does,
+  stitching it from the tiles of the file in the tile cache. Tiles are
+  tile_size x tile_size degree blocks of the grid of the file, in its own
+  order and longitudes, holding all the frames of the day. The tiles of
+  the region not cached yet are read from the file with the backend and
+  saved first, those already cached are not read again. If another
+  process evicts the tiles meanwhile, the file is read with the backend
+  '''
+  try:
+    return load_cached_tiles(filename,region,frames,backend)
+  except FileNotFoundError:
+    return BACKENDS[backend]['load'](filename,region,frames)
+
+# load_cached_tiles
+###################################
+
+def load_cached_tiles(filename,region,frames,backend):
+  '''
+  Reads the region and the frames of a daily file from its tiles, see
+  load_tiles. Raises FileNotFoundError if tiles are evicted while read
+  '''
+  day_dir=tile_day_dir(filename,backend)
+  header=tile_header(filename,day_dir)
+  lats=header['lats']
+  lons=header['lons']
+
+  # Tiles of the points of the region, in the order of the grid
+  lat_slice,lon_slices=region_slices(lons,lats,region)
+  lon_idx=np.sort(np.concatenate([np.arange(len(lons))[lon_slice] for lon_slice in lon_slices]))
+  lat_keys=tile_keys(lats[lat_slice])
+  lon_keys=tile_keys(lons[lon_idx])
+
+  tile_file=lambda i,j: os.path.join(day_dir,'tile_{:d}_{:d}.npz'.format(i,j))
+  missing=[(i,j) for i in lat_keys for j in lon_keys if not os.path.exists(tile_file(i,j))]
+  # The frame times and metadata are saved along with the tiles
+  if 'times' not in header and not missing:
+    missing=[(lat_keys[0],lon_keys[0])]
+  if missing:
+    header=fill_tiles(filename,day_dir,header,missing,backend)
+    evict_tiles()
+
+  rows=[]
+  for i in lat_keys:
+    row=[]
+    for j in lon_keys:
+      with np.load(tile_file(i,j)) as tile:
+        row.append(dict((name,tile[name]) for name in tile.files))
+      # Most recently used tiles are evicted last
+      os.utime(tile_file(i,j))
+    rows.append(row)
+
+  # Tiles side by side in longitude, rows of them in latitude
+  stitch=lambda name: np.concatenate([np.concatenate([tile[name] for tile in row],axis=-1)
+                                      for row in rows],axis=-2)
+  data=np.ma.array(stitch('data'),mask=stitch('mask'))
+
+  field=GPMField(data[frames],
+                 header['times'][frames],
+                 np.concatenate([row[0]['lats'] for row in rows]),
+                 np.concatenate([tile['lons'] for tile in rows[0]]),
+                 time_bounds=None if header['time_bounds'] is None else header['time_bounds'][frames],
+                 lat_bounds=np.concatenate([row[0]['lat_bounds'] for row in rows]) if 'lat_bounds' in rows[0][0] else None,
+                 lon_bounds=np.concatenate([tile['lon_bounds'] for tile in rows[0]]) if 'lon_bounds' in rows[0][0] else None,
+                 meta=header['meta'])
+
+  return cut_region(field,region)
+
+# tile_day_dir
+###################################
+
+def tile_day_dir(filename,backend):
+  '''
+  Returns the directory of the tiles of a daily file read with the
+  backend, named after its modification time and size so the tiles of a
+  file refreshed are not used again
+  '''
+  stat=os.stat(filename)
+  name='{:s}_{:d}_{:d}_{:s}_{:g}'.format(os.path.splitext(os.path.basename(filename))[0],
+                                         int(stat.st_mtime),stat.st_size,backend,tile_size)
+
+  return os.path.join(tile_cache_dir,name)
+
+# tile_header
+###################################
+
+def tile_header(filename,day_dir):
+  '''
+  Returns the header of the tiles of a daily file, with the latitudes and
+  longitudes of its grid, and once tiles have been saved the frame times
+  and bounds and the metadata of the backend
+  '''
+  header_file=os.path.join(day_dir,'header.pkl')
+  if os.path.exists(header_file):
+    with open(header_file,'rb') as f:
+      return pickle.load(f)
+
+  # The grid of the file, read without the data
+  with netCDF4.Dataset(filename,'r') as dataset:
+    nc_var,nc_time,nc_lat,nc_lon=netcdf4_find_variable(dataset)
+    return {'lats':np.ma.filled(nc_lat[:]),'lons':np.ma.filled(nc_lon[:])}
+
+# tile_keys
+###################################
+
+def tile_keys(points):
+  '''
+  Returns the tiles of the coordinate points, in the order of the points
+  '''
+  keys=[]
+  for key in np.floor(points/tile_size).astype(int):
+    if not keys or keys[-1] != key:
+      keys.append(int(key))
+
+  return keys
+
+# fill_tiles
+###################################
+
+def fill_tiles(filename,day_dir,header,tiles,backend):
+  '''
+  Reads the (lat key, lon key) tiles of a daily file with the backend and
+  saves them to day_dir along with their header. Columns of tiles missing
+  the same lat keys are read together, one read per run of contiguous
+  latitudes and longitudes, so tiles already cached are not read again.
+  Returns the header
+  '''
+  lats=header['lats']
+  lons=header['lons']
+  lat_tile=np.floor(lats/tile_size).astype(int)
+  lon_tile=np.floor(lons/tile_size).astype(int)
+
+  # Lon keys of the tiles to read, grouped by their lat keys
+  columns=collections.OrderedDict()
+  for i,j in tiles:
+    columns.setdefault(j,[]).append(i)
+  blocks=collections.OrderedDict()
+  for j,lat_keys in columns.items():
+    blocks.setdefault(tuple(lat_keys),[]).append(j)
+
+  # Reading from the first point of each run keeps those of the grid
+  runs=lambda idx: np.split(idx,np.where(np.diff(idx) != 1)[0]+1)
+  reads=[]
+  for lat_keys,lon_keys in blocks.items():
+    for lat_run in runs(np.where(np.isin(lat_tile,lat_keys))[0]):
+      for lon_run in runs(np.where(np.isin(lon_tile,lon_keys))[0]):
+        reads.append([float(lons[lon_run[0]]),float(lats[lat_run].min()),
+                      float(lons[lon_run[-1]]),float(lats[lat_run].max())])
+
+  if not os.path.exists(day_dir):
+    os.makedirs(day_dir,exist_ok=True)
+
+  for box in reads:
+    block=BACKENDS[backend]['load'](filename,box)
+    block_lat_tile=np.floor(block.lats/tile_size).astype(int)
+    block_lon_tile=np.floor(block.lons/tile_size).astype(int)
+    for i in set(block_lat_tile):
+      for j in set(block_lon_tile):
+        lat_in=block_lat_tile == i
+        lon_in=block_lon_tile == j
+        tile={'data':np.ma.getdata(block.data)[:,lat_in][:,:,lon_in],
+              'mask':np.ma.getmaskarray(block.data)[:,lat_in][:,:,lon_in],
+              'lats':block.lats[lat_in],
+              'lons':block.lons[lon_in]}
+        if block.lat_bounds is not None:
+          tile['lat_bounds']=block.lat_bounds[lat_in]
+        if block.lon_bounds is not None:
+          tile['lon_bounds']=block.lon_bounds[lon_in]
+        # Written aside and renamed, another process may be reading it
+        tile_file=os.path.join(day_dir,'tile_{:d}_{:d}.npz'.format(i,j))
+        with tile_writer(tile_file) as f:
+          np.savez_compressed(f,**tile)
+
+  header=dict(header,times=list(block.times),
+              time_bounds=None if block.time_bounds is None else list(block.time_bounds),
+              meta=block.meta)
+  with tile_writer(os.path.join(day_dir,'header.pkl')) as f:
+    pickle.dump(header,f)
+
+  return header
+
+# tile_writer
+###################################
+
+@contextlib.contextmanager
+def tile_writer(filename):
+  '''
+  Yields a binary file to write, renamed to filename when done. The file
+  is unique to the caller, so workers filling the tiles of the same daily
+  file at once (the closing frame of a day is the first of the next)
+  do not write over each other
+  '''
+  handle,tmp_file=tempfile.mkstemp(dir=os.path.dirname(filename),suffix='.tmp')
+  try:
+    with os.fdopen(handle,'wb') as f:
+      yield f
+    os.replace(tmp_file,filename)
+  except BaseException:
+    if os.path.exists(tmp_file):
+      os.remove(tmp_file)
+    raise
+
+# evict_tiles
+###################################
+
+def evict_tiles():
+  '''
+  Removes the tiles least recently used until the tile cache is within
+  tile_cache_size GB, and the directories of the files left without tiles
+  '''
+  tiles=[]
+  for entry in os.scandir(tile_cache_dir):
+    if entry.is_dir():
+      for tile in os.scandir(entry.path):
+        if tile.name.endswith('.npz'):
+          stat=tile.stat()
+          tiles.append((stat.st_mtime,stat.st_size,tile.path))
+
+  # Other workers may be evicting or filling tiles at the same time
+  total=sum(size for mtime,size,path in tiles)
+  for mtime,size,path in sorted(tiles):
+    if total <= tile_cache_size*1024.**3:
+      break
+    total=total-size
+    try:
+      os.remove(path)
+      day_dir=os.path.dirname(path)
+      names=os.listdir(day_dir)
+      if not any(name.endswith('.npz') or name.endswith('.tmp') for name in names):
+        for name in names:
+          os.remove(os.path.join(day_dir,name))
+        os.rmdir(day_dir)
+    except OSError:
+      # Removed by another worker, or tiles being written meanwhile
+      pass
+
+# region_slices
+###################################
+
+def region_slices(lons,lats,region):
+  '''
+  Converts the E,S,W,N region into index slices of the lons and lats
+  coordinate points. Returns the latitude slice and a list with the
+  longitude slices: one, or two when the region wraps around the edge
+  of the grid (e.g. across the dateline), in E to W order.
+  '''
+  # Latitudes within the box, the grid is monotonic so they are contiguous
+  lat_idx=np.where((lats >= region[1]) & (lats <= region[3]))[0]
+  if lat_idx.size == 0:
+    raise ValueError("No latitudes between {} and {} in the GPM grid".format(region[1],region[3]))
+  lat_slice=slice(lat_idx[0],lat_idx[-1]+1)
+
+  # Longitudes counted eastward from E, as intersection() does
+  offset=(lons-region[0]) % 360.
+  lon_idx=np.where(offset <= region[2]-region[0])[0]
+  if lon_idx.size == 0:
+    raise ValueError("No longitudes between {} and {} in the GPM grid".format(region[0],region[2]))
+  lon_idx=lon_idx[np.argsort(offset[lon_idx],kind='stable')]
+
+  # Split in contiguous runs of indices (two if the box wraps around)
+  breaks=np.where(np.diff(lon_idx) != 1)[0]+1
+  lon_slices=[slice(run[0],run[-1]+1) for run in np.split(lon_idx,breaks)]
+
+  return lat_slice,lon_slices
+
+# lon_shift
+###################################
+
+def lon_shift(lons,region):
+  '''
+  Returns the shift to take a contiguous piece of longitudes
+  into [E, E+360)
+  '''
+  return lons[0]-(region[0]+(lons[0]-region[0]) % 360.)
+
+# cut_region
+###################################
+
+def cut_region(field,region):
+  '''
+  Cuts-off the region of a GPMField in memory, longitudes are returned
+  within [E, E+360)
+  '''
+  lat_slice,lon_slices=region_slices(field.lons,field.lats,region)
+
+  lons=[]
+  lon_bounds=[]
+  for lon_slice in lon_slices:
+    shift=lon_shift(field.lons[lon_slice],region)
+    lons.append(field.lons[lon_slice]-shift)
+    if field.lon_bounds is not None:
+      lon_bounds.append(field.lon_bounds[lon_slice]-shift)
+
+  return GPMField(np.ma.concatenate([field.data[...,lat_slice,lon_slice] for lon_slice in lon_slices],axis=-1),
+                  field.times,
+                  field.lats[lat_slice],
+                  np.concatenate(lons),
+                  time_bounds=field.time_bounds,
+                  lat_bounds=None if field.lat_bounds is None else field.lat_bounds[lat_slice],
+                  lon_bounds=np.concatenate(lon_bounds) if lon_bounds else None,
+                  meta=field.meta)
+
+# get_gpm_cubes
+###################################
+
+def get_gpm_cubes(time_i,region,interval,product,day_cube=None,backend='iris'):
+  '''
+  Select the rainfall accumulation fields over the selected time,
+  time_i <= time <= time_f, and averages over time. The frames are taken
+  from day_cube (see load_gpm_frames) if given, otherwise they are loaded
+  from the daily files the window spans and the region cut-off here.
+  Returns a GPMField
+  '''
+
+  if day_cube is None:
+    time_f=time_i + datetime.timedelta(hours=interval)
+    update_catalog(time_i,time_f,product)
+    # Check if production has got time requested (may be too close to real time!)
+    missing=window_missing(time_i,interval,product)
+    if product=='production' and missing:
+      raise FileNotFoundError("File {:s} not found. Production has not reached this date".format(missing[0]))
+    day_cube=load_gpm_frames(catalog_sources(time_i,time_f,product),region,backend)
+
+  return get_gpm_windows(day_cube,[(time_i,interval)])[(time_i,interval)]
+
+# get_gpm_windows
+###################################
+
+def get_gpm_windows(day_field,windows):
+  '''
+  Averages all the (start time, interval) windows of a day from a single
+  pass over the half-hourly frames of day_field (see load_gpm_frames).
+  As in get_gpm_cubes a window takes the frames time_i <= time <= time_f.
+  The frames are summed once in blocks [t, t+dt) of the finest interval dt,
+  coarser windows are aggregated from those blocks plus their closing frame.
+  Returns a dictionary of GPMFields keyed by (start time, interval)
+  '''
+  times=day_field.times
+  data=day_field.data
+
+  def frame_range(time_a,time_b):
+    # Indices of frames within [time_a, time_b)
+    return bisect.bisect_left(times,time_a),bisect.bisect_left(times,time_b)
+
+  # Block sums and counts of valid frames at the finest interval
+  step=datetime.timedelta(hours=min(interval for time_iter,interval in windows))
+  blocks={}
+  block_time=windows[0][0]
+  while block_time <= times[-1]:
+    k0,k1=frame_range(block_time,block_time+step)
+    blocks[block_time]=(np.ma.filled(data[k0:k1].sum(axis=0),0.),data[k0:k1].count(axis=0))
+    block_time=block_time+step
+
+  fields={}
+  for time_i,interval in windows:
+    time_f=time_i + datetime.timedelta(hours=interval)
+
+    # Blocks within the window
+    total=0.
+    count=0
+    block_time=time_i
+    while block_time < time_f:
+      if block_time in blocks:
+        total=total+blocks[block_time][0]
+        count=count+blocks[block_time][1]
+      block_time=block_time+step
+
+    # Frame closing the window
+    k0,k1=frame_range(time_i,time_f)
+    if k1 < len(times) and times[k1] == time_f:
+      total=total+np.ma.filled(data[k1],0.)
+      count=count+data[k1:k1+1].count(axis=0)
+      k1=k1+1
+
+    if k0 == k1:
+      raise ValueError("No GPM frames between {:%HZ %d/%m/%Y} and {:%HZ %d/%m/%Y}".format(time_i,time_f))
+
+    mean=np.ma.masked_where(count == 0,total/np.maximum(count,1))
+    fields[(time_i,interval)]=window_field(day_field,k0,k1-1,mean)
+
+  return fields
+
+# window_field
+###################################
+
+def window_field(day_field,k0,k1,mean):
+  '''
+  Returns the GPMField of the window made of frames k0 to k1 of day_field
+  with the averaged data. Its time is the middle of the window bounds,
+  from the start of frame k0 to the end of frame k1, as collapsing the
+  time coordinate with Iris gives
+  '''
+  if day_field.time_bounds is not None:
+    bounds=(day_field.time_bounds[k0][0],day_field.time_bounds[k1][1])
+  else:
+    bounds=(day_field.times[k0],day_field.times[k1])
+
+  return GPMField(mean.astype(day_field.data.dtype),
+                  [bounds[0]+(bounds[1]-bounds[0])/2],
+                  day_field.lats,
+                  day_field.lons,
+                  time_bounds=[bounds],
+                  lat_bounds=day_field.lat_bounds,
+                  lon_bounds=day_field.lon_bounds,
+                  meta=day_field.meta)
 
 # gpm_cube_save
 ###################################
 
-def gpm_cube_save(cube,time_i,interval,path_out):
+def gpm_cube_save(cube,time_i,interval,path_out,backend='iris'):
   '''
-  Saves NetCDF cube with the hourly accumulated precipitation interval chosen
-  at the path_out file
+  Saves NetCDF cube, a GPMField, with the hourly accumulated precipitation
+  interval chosen at the path_out file with the given backend
+  '''
+  #Set output filename and save
+  fileout=gpm_out_file(time_i,interval,path_out)
+  with netcdf_lock:
+    BACKENDS[backend]['save'](cube,fileout)
+
+  return fileout
+
+# gpm_out_file
+###################################
+
+def gpm_out_file(time_i,interval,path_out):
+  '''
+  Returns the file gpm_cube_save writes the window to
   '''
   time_f=time_i + datetime.timedelta(hours=interval)
 
+  return gpm_out_dir(interval,path_out)+'/GPM_'+GPM_V+'_'+time_i.strftime('%Y%m%d%H')+'_'+time_f.strftime('%Y%m%d%H')+'.nc'
+
+# gpm_out_dir
+###################################
+
+def gpm_out_dir(interval,path_out):
+  '''
+  Returns the output directory of the interval within path_out, making it
+  if needed
+  '''
   if interval==1:
     int_dir='hourly'
   elif interval==3:
@@ -272,20 +1626,1004 @@ def gpm_cube_save(cube,time_i,interval,path_out):
     int_dir='6hourly'
   elif interval==24:
     int_dir='daily'
-    
 
   #Set and make dir
   dirname=path_out+'/'+int_dir
 
   if not os.path.exists(dirname):
     try:
-        os.makedirs(dirname)
+        os.makedirs(dirname,exist_ok=True)
     except OSError as exc:
       raise PermissionError('Do not have permissions to create output dir at "'+dirname+"'") from exc
 
-  #Set output filename and save
-  fileout=dirname+'/GPM_'+GPM_V+'_'+time_i.strftime('%Y%m%d%H')+'_'+time_f.strftime('%Y%m%d%H')+'.nc'
-  iris.save(cube,fileout)
+  return dirname
+
+# gpm_timeseries_save
+###################################
+
+def gpm_timeseries_save(field,interval,path_out,args,datasets):
+  '''
+  Writes the window field into the time-chunked NetCDF4 file of its interval
+  at path_out, creating the file with the compression, packing and chunk
+  options in args if needed. Windows are placed on a fixed time grid, a
+  window already in the file is overwritten and those missing before it
+  hold no data until written. Open files are kept in datasets.
+  Returns the name of the file
+  '''
+  fileout=gpm_out_dir(interval,path_out)+'/GPM_'+GPM_V+'_timeseries.nc'
+
+  if fileout not in datasets:
+    if os.path.exists(fileout):
+      datasets[fileout]=netCDF4.Dataset(fileout,'a')
+    else:
+      datasets[fileout]=create_timeseries(fileout,field,args)
+    set_chunk_cache(datasets[fileout].variables[field.meta['var_name'] or 'precipitation'])
+  dataset=datasets[fileout]
+
+  # Window time and bounds in the units of the file
+  nc_time=dataset.variables['time']
+  point=netCDF4.date2num(field.times[0],nc_time.units,nc_time.calendar)
+  bounds=netCDF4.date2num(list(field.time_bounds[0]),nc_time.units,nc_time.calendar)
+
+  # Index of the window on the time grid of the file, from its first window
+  # every interval hours, so windows missing (e.g. a day that failed) are
+  # left as no data and can be written later
+  ntimes=len(nc_time)
+  if ntimes == 0:
+    index=0
+  else:
+    first=dataset.variables['time_bnds'][0,:]
+    step=netCDF4.date2num(field.time_bounds[0][0]+datetime.timedelta(hours=interval),
+                          nc_time.units,nc_time.calendar)-bounds[0]
+    offset=(bounds[0]-first[0])/step
+    index=int(round(offset))
+    if index < 0 or abs(offset-index) > 1e-6:
+      raise ValueError("Window not on the {:d}h time grid of {:s} starting at {:s}".format(
+                       interval,fileout,str(netCDF4.num2date(first[0],nc_time.units,nc_time.calendar))))
+    # Times of the windows missing up to this one
+    if index > ntimes:
+      gap=np.arange(ntimes,index)
+      nc_time[ntimes:index]=nc_time[0]+gap*step
+      dataset.variables['time_bnds'][ntimes:index,:]=first[np.newaxis,:]+gap[:,np.newaxis]*step
+
+  data=field.data
+  if args.pack_scale:
+    # Keep values within the range of the packed int16
+    data=np.ma.clip(data,0.,32766*args.pack_scale)
+
+  nc_time[index]=point
+  dataset.variables['time_bnds'][index,:]=bounds
+  dataset.variables[field.meta['var_name'] or 'precipitation'][index,:,:]=data
+
+  return fileout
+
+# set_chunk_cache
+###################################
+
+def set_chunk_cache(nc_var):
+  '''
+  Sizes the chunk cache of the variable to hold a row of chunks in time,
+  those of the whole grid, so writing one time step after another does
+  not read back and compress again the chunks evicted in between
+  '''
+  chunks=nc_var.chunking()
+  if chunks == 'contiguous':
+    return
+  nchunks=1
+  for length,chunk in zip(nc_var.shape[1:],chunks[1:]):
+    nchunks=nchunks*-(-length//chunk)
+  size=nchunks*int(np.prod(chunks))*nc_var.dtype.itemsize
+  nc_var.set_var_chunk_cache(size=size,nelems=10*nchunks+1,preemption=1.)
+
+# create_timeseries
+###################################
+
+def create_timeseries(fileout,field,args):
+  '''
+  Creates the NetCDF4 timeseries file for windows like field, with an
+  unlimited time dimension, zlib/shuffle compression, optional int16
+  packing and chunks of args.chunks, a row of them in time is cached
+  while writing (see set_chunk_cache)
+  '''
+  meta=field.meta
+
+  dataset=netCDF4.Dataset(fileout,'w',format='NETCDF4')
+  dataset.Conventions='CF-1.7'
+  dataset.source='GPM-IMERG '+GPM_V
+
+  dataset.createDimension('time',None)
+  dataset.createDimension('bnds',2)
+
+  nc_time=dataset.createVariable('time','f8',('time',))
+  nc_time.units=meta['time_units']
+  nc_time.calendar=meta['time_calendar']
+  nc_time.standard_name='time'
+  nc_time.bounds='time_bnds'
+  dataset.createVariable('time_bnds','f8',('time','bnds'))
+
+  create_latlon(dataset,field)
+
+  # Chunks along time and small in space, no larger than the grid
+  chunks=[args.chunks[0],min(args.chunks[1],len(field.lats)),min(args.chunks[2],len(field.lons))]
+  if args.pack_scale:
+    dtype='i2'
+    fill_value=np.int16(-32768)
+  else:
+    dtype='f4'
+    fill_value=np.float32(netCDF4.default_fillvals['f4'])
+
+  nc_var=dataset.createVariable(meta['var_name'] or 'precipitation',dtype,
+                                ('time','latitude','longitude'),
+                                zlib=args.complevel > 0,complevel=max(args.complevel,1),
+                                shuffle=args.shuffle,chunksizes=chunks,
+                                fill_value=fill_value)
+  if args.pack_scale:
+    nc_var.scale_factor=args.pack_scale
+    nc_var.add_offset=0.
+  nc_var.units=meta['units']
+  nc_var.long_name=meta['long_name'] or meta['var_name']
+  nc_var.cell_methods='time: mean'
+
+  return dataset
+
+# create_latlon
+###################################
+
+def create_latlon(dataset,field):
+  '''
+  Creates the latitude and longitude dimensions and coordinates of field
+  in a NetCDF4 dataset
+  '''
+  for name,points in (('latitude',field.lats),('longitude',field.lons)):
+    dataset.createDimension(name,len(points))
+    nc_coord=dataset.createVariable(name,'f4',(name,))
+    nc_coord[:]=points
+    nc_coord.units=field.meta[name+'_units']
+    nc_coord.standard_name=name
+
+# gpm_cumsum_save
+###################################
+
+# Last edge of the cumulative sum stores written in the run,
+# {fileout: (index, accumulation, count)}, so a day is summed from it
+# without reading it back
+_cumsum_last={}
+
+def gpm_cumsum_save(day_field,path_out,args,datasets):
+  '''
+  Adds the half-hourly frames of day_field to the cumulative sum store at
+  path_out. The store keeps, at frame edges t0, t0+30min, ..., the rainfall
+  accumulated since t0 (mm) and the number of valid frames, so the
+  accumulation between any two edges is the difference of two slices
+  (see GPM_query.py). Missing frames are stored as no data. The edges of
+  the day are summed in memory and written as one block. Frames already
+  in the store are replaced, e.g. when an NRT file has been refreshed,
+  by shifting all the later edges. Returns the name of the store
+  '''
+  fileout=path_out+'/GPM_'+GPM_V+'_cumsum.nc'
+  if fileout not in datasets:
+    if os.path.exists(fileout):
+      datasets[fileout]=netCDF4.Dataset(fileout,'a')
+    else:
+      if not os.path.exists(path_out):
+        os.makedirs(path_out,exist_ok=True)
+      datasets[fileout]=create_cumsum(fileout,day_field,args)
+    _cumsum_last.pop(fileout,None)
+  dataset=datasets[fileout]
+
+  nc_time=dataset.variables['time']
+  nc_acc=dataset.variables['accumulation']
+  nc_count=dataset.variables['count']
+  to_file=lambda t: netCDF4.date2num(t,nc_time.units,nc_time.calendar)
+
+  if len(nc_time) == 0:
+    # First edge of the store
+    nc_time[0]=to_file(day_field.times[0])
+    nc_acc[0,:,:]=0.
+    nc_count[0,:,:]=0
+  if fileout not in _cumsum_last:
+    last=len(nc_time)-1
+    _cumsum_last[fileout]=(last,np.ma.getdata(nc_acc[last,:,:]),np.ma.getdata(nc_count[last,:,:]))
+  last,last_acc,last_count=_cumsum_last[fileout]
+
+  # Edges of the frames, counted in half hours (the store is in minutes)
+  start=nc_time[0]
+  slots=[int(round((to_file(frame)-start)/30.)) for frame in day_field.times]
+  if slots[0] < 0:
+    raise ValueError("Frame {:%HZ %d/%m/%Y} is before the start of {:s}".format(day_field.times[0],fileout))
+
+  # Frames missing since the last edge are stored as no data, a day at a time
+  while last < slots[0]:
+    n=min(slots[0]-last,48)
+    nc_time[last+1:last+n+1]=start+30.*np.arange(last+1,last+n+1)
+    nc_acc[last+1:last+n+1,:,:]=np.broadcast_to(last_acc,(n,)+last_acc.shape)
+    nc_count[last+1:last+n+1,:,:]=np.broadcast_to(last_count,(n,)+last_count.shape)
+    last=last+n
+
+  # Edges first to end spanned by the day, those already in the store read
+  # back unless the first is the last one, kept in memory
+  first=slots[0]
+  end=slots[-1]+1
+  stored=min(end,last)
+  if stored > first:
+    old_acc=np.ma.getdata(nc_acc[first:stored+1,:,:])
+    old_count=np.ma.getdata(nc_count[first:stored+1,:,:])
+  else:
+    old_acc=last_acc[np.newaxis]
+    old_count=last_count[np.newaxis]
+
+  # Increments of the edges from the first, the frames of the day or those
+  # of the store where the day has no frame, summed in time order
+  acc=np.zeros((end-first+1,)+last_acc.shape,'f8')
+  count=np.zeros((end-first+1,)+last_count.shape,'i4')
+  acc[0]=old_acc[0]
+  count[0]=old_count[0]
+  acc[1:len(old_acc)]=np.diff(old_acc,axis=0)
+  count[1:len(old_count)]=np.diff(old_count,axis=0)
+  data=day_field.data
+  for k,slot in enumerate(slots):
+    acc[slot-first+1]=np.ma.filled(data[k],0.).astype('f8')*0.5
+    count[slot-first+1]=~np.ma.getmaskarray(data[k])
+  np.cumsum(acc,axis=0,out=acc)
+  np.cumsum(count,axis=0,out=count)
+
+  if end > last:
+    nc_time[last+1:end+1]=start+30.*np.arange(last+1,end+1)
+  nc_acc[first+1:end+1,:,:]=acc[1:]
+  nc_count[first+1:end+1,:,:]=count[1:]
+
+  if end >= last:
+    last,last_acc,last_count=end,acc[-1],count[-1]
+  else:
+    # Shift the later edges by the change of the day, a day at a time
+    delta=acc[-1]-old_acc[-1]
+    delta_count=count[-1]-old_count[-1]
+    if np.any(delta != 0) or np.any(delta_count != 0):
+      for i in range(end+1,last+1,48):
+        j=min(i+48,last+1)
+        nc_acc[i:j,:,:]=nc_acc[i:j,:,:]+delta
+        nc_count[i:j,:,:]=nc_count[i:j,:,:]+delta_count
+      last_acc=last_acc+delta
+      last_count=last_count+delta_count
+  _cumsum_last[fileout]=(last,last_acc,last_count)
+
+  return fileout
+
+# create_cumsum
+###################################
+
+def create_cumsum(fileout,day_field,args):
+  '''
+  Creates the NetCDF4 cumulative sum store for the grid of day_field, with
+  double precision sums and one edge per chunk in time
+  '''
+
+  dataset=netCDF4.Dataset(fileout,'w',format='NETCDF4')
+  dataset.Conventions='CF-1.7'
+  dataset.source='GPM-IMERG '+GPM_V
+  dataset.comment=('Rainfall accumulated since the first time, the accumulation between '
+                   'two times is the difference of their fields')
+
+  dataset.createDimension('time',None)
+
+  nc_time=dataset.createVariable('time','f8',('time',))
+  nc_time.units='minutes since 1970-01-01 00:00:00'
+  nc_time.calendar='standard'
+  nc_time.standard_name='time'
+
+  create_latlon(dataset,day_field)
+
+  # Queries read two edges, so each is decompressed on its own, and the
+  # edges of a day are written once as a block. args.chunks is for the
+  # windows of timeseries output
+  chunks=[1,min(256,len(day_field.lats)),min(256,len(day_field.lons))]
+  options=dict(zlib=args.complevel > 0,complevel=max(args.complevel,1),
+               shuffle=args.shuffle,chunksizes=chunks)
+
+  nc_acc=dataset.createVariable('accumulation','f8',('time','latitude','longitude'),**options)
+  nc_acc.units='mm'
+  nc_acc.long_name='precipitation accumulated since the first time'
+
+  nc_count=dataset.createVariable('count','i4',('time','latitude','longitude'),**options)
+  nc_count.units='1'
+  nc_count.long_name='number of valid half-hourly frames since the first time'
+
+  return dataset
+
+# gpm_stats_add
+###################################
+
+def gpm_stats_add(field,interval,path_out,args,datasets):
+  '''
+  Adds the window field to the statistics of its interval at path_out,
+  kept in datasets as a GPMStats until it is closed at the end of the run.
+  Returns the name of the file the statistics are saved to
+  '''
+  fileout=gpm_out_dir(interval,path_out)+'/GPM_'+GPM_V+'_stats_'+args.init_time.strftime('%Y%m%d%H')+'_'+args.final_time.strftime('%Y%m%d%H')+'.nc'
+
+  if fileout not in datasets:
+    datasets[fileout]=GPMStats(fileout,field,args)
+  datasets[fileout].add(field)
+
+  return fileout
+
+# GPMStats
+###################################
+
+class GPMStats(object):
+  '''
+  Running statistics per grid point of the windows added, in memory of
+  the size of the grid times the number of thresholds and histogram bins.
+  Mean and variance are updated with Welford's algorithm, percentiles are
+  interpolated within the bins of a histogram of the rain rates, with
+  log-spaced edges from 0.01 to 500 mm/hr (the last bin is open ended).
+  Masked points are left out. Like the NetCDF datasets of the other output
+  modes it is saved to fileout on close
+  '''
+  def __init__(self,fileout,field,args):
+    self.fileout=fileout
+    self.lats=field.lats
+    self.lons=field.lons
+    self.meta=field.meta
+    self.thresholds=np.array(args.thresholds)
+    self.percentiles=np.array(args.percentiles)
+    self.edges=np.concatenate([[0.],np.logspace(-2,np.log10(500.),args.hist_bins)])
+    self.time_bounds=None
+
+    shape=(len(field.lats),len(field.lons))
+    self.count=np.zeros(shape,'i4')
+    self.mean=np.zeros(shape,'f8')
+    self.m2=np.zeros(shape,'f8')
+    self.maximum=np.full(shape,-np.inf)
+    self.exceedances=np.zeros((len(self.thresholds),)+shape,'i4')
+    self.histogram=np.zeros((args.hist_bins,)+shape,'i4')
+
+  def add(self,field):
+    '''
+    Adds the (lat, lon) window field
+    '''
+    valid=~np.ma.getmaskarray(field.data)
+    x=np.ma.filled(field.data,0.).astype('f8')
+
+    self.count+=valid
+    delta=np.where(valid,x-self.mean,0.)
+    self.mean+=delta/np.maximum(self.count,1)
+    self.m2+=delta*np.where(valid,x-self.mean,0.)
+    self.maximum=np.where(valid & (x > self.maximum),x,self.maximum)
+
+    for i,threshold in enumerate(self.thresholds):
+      self.exceedances[i]+=valid & (x >= threshold)
+
+    # Every point is in one bin only, so fancy indexing adds them all
+    k=np.clip(np.searchsorted(self.edges,x,side='right')-1,0,len(self.histogram)-1)
+    rows,cols=np.nonzero(valid)
+    self.histogram[k[rows,cols],rows,cols]+=1
+
+    bounds=field.time_bounds[0]
+    if self.time_bounds is None:
+      self.time_bounds=list(bounds)
+    else:
+      self.time_bounds=[min(self.time_bounds[0],bounds[0]),max(self.time_bounds[1],bounds[1])]
+
+  def percentile(self,q):
+    '''
+    Returns the q percentile per grid point interpolated linearly within
+    the histogram bin holding it, masked where there are no windows
+    '''
+    cumulative=np.cumsum(self.histogram,axis=0)
+    rank=np.maximum(q/100.*self.count,1e-6)
+
+    # First bin reaching the rank, its lower and upper edges
+    k=np.minimum((cumulative < rank).sum(axis=0),len(self.histogram)-1)
+    rows,cols=np.indices(k.shape)
+    below=np.where(k > 0,cumulative[np.maximum(k-1,0),rows,cols],0)
+    in_bin=self.histogram[k,rows,cols]
+    lower=self.edges[k]
+    upper=np.minimum(self.edges[np.minimum(k+1,len(self.edges)-1)],self.maximum)
+    upper=np.where(k == len(self.histogram)-1,self.maximum,upper)
+
+    value=lower+(rank-below)/np.maximum(in_bin,1)*np.maximum(upper-lower,0.)
+
+    return np.ma.masked_where(self.count == 0,np.minimum(value,self.maximum))
+
+  def sync(self):
+    '''
+    Nothing to flush, the statistics are saved on close
+    '''
+    pass
+
+  def close(self):
+    '''
+    Saves the statistics to fileout
+    '''
+    meta=self.meta
+    units=meta['units']
+    no_data=self.count == 0
+
+    dataset=netCDF4.Dataset(self.fileout,'w',format='NETCDF4')
+    dataset.Conventions='CF-1.7'
+    dataset.source='GPM-IMERG '+GPM_V
+    dataset.comment=('Statistics of the windows in the period, percentiles are approximated '
+                     'from a histogram of {:d} bins'.format(len(self.histogram)))
+
+    dataset.createDimension('bnds',2)
+    dataset.createDimension('threshold',len(self.thresholds))
+    dataset.createDimension('percentile',len(self.percentiles))
+
+    nc_time=dataset.createVariable('time','f8',())
+    nc_time.units='minutes since 1970-01-01 00:00:00'
+    nc_time.calendar='standard'
+    nc_time.standard_name='time'
+    nc_time.bounds='time_bnds'
+    nc_bnds=dataset.createVariable('time_bnds','f8',('bnds',))
+    if self.time_bounds is not None:
+      nc_bnds[:]=netCDF4.date2num(self.time_bounds,nc_time.units,nc_time.calendar)
+      nc_time.assignValue(nc_bnds[:].mean())
+
+    create_latlon(dataset,self)
+
+    nc_threshold=dataset.createVariable('threshold','f4',('threshold',))
+    nc_threshold[:]=self.thresholds
+    nc_threshold.units=units
+    nc_percentile=dataset.createVariable('percentile','f4',('percentile',))
+    nc_percentile[:]=self.percentiles
+    nc_percentile.units='%'
+
+    options=dict(zlib=True,fill_value=np.float32(netCDF4.default_fillvals['f4']))
+    grid=('latitude','longitude')
+
+    nc_count=dataset.createVariable('count','i4',grid,zlib=True)
+    nc_count[:]=self.count
+    nc_count.long_name='number of valid windows'
+
+    nc_mean=dataset.createVariable('mean','f4',grid,**options)
+    nc_mean[:]=np.ma.masked_where(no_data,self.mean)
+    nc_mean.units=units
+    nc_mean.cell_methods='time: mean'
+
+    nc_var=dataset.createVariable('variance','f4',grid,**options)
+    nc_var[:]=np.ma.masked_where(self.count < 2,self.m2/np.maximum(self.count-1,1))
+    nc_var.units='('+units+')2'
+    nc_var.cell_methods='time: variance'
+
+    nc_max=dataset.createVariable('maximum','f4',grid,**options)
+    nc_max[:]=np.ma.masked_where(no_data,self.maximum)
+    nc_max.units=units
+    nc_max.cell_methods='time: maximum'
+
+    nc_exc=dataset.createVariable('exceedances','i4',('threshold',)+grid,zlib=True)
+    nc_exc[:]=self.exceedances
+    nc_exc.long_name='number of windows at or above the threshold'
+
+    nc_pct=dataset.createVariable('percentiles','f4',('percentile',)+grid,**options)
+    nc_pct[:]=np.ma.array([self.percentile(q) for q in self.percentiles])
+    nc_pct.units=units
+    nc_pct.long_name='approximate percentiles of the windows'
+
+    dataset.close()
+
+# manifest_filename
+###################################
+
+def manifest_filename(path_out):
+  '''
+  Returns the manifest file, next to the output directories
+  '''
+  return os.path.join(path_out,'GPM_'+GPM_V+'_manifest.json')
+
+# read_manifest
+###################################
+
+def read_manifest(path_out):
+  '''
+  Reads the manifest of the windows already done at path_out, a
+  dictionary of records keyed by manifest_key. Empty if there is none
+  '''
+  filename=manifest_filename(path_out)
+  if not os.path.exists(filename):
+    return {}
+
+  with open(filename,'r') as f:
+    return json.load(f)
+
+# write_manifest
+###################################
+
+def write_manifest(manifest,path_out):
+  '''
+  Writes the manifest atomically, an interrupted run keeps the previous one
+  '''
+  filename=manifest_filename(path_out)
+  if not os.path.exists(path_out):
+    os.makedirs(path_out,exist_ok=True)
+
+  with open(filename+'.tmp','w') as f:
+    json.dump(manifest,f,indent=1,sort_keys=True)
+  os.replace(filename+'.tmp',filename)
+
+# manifest_key
+###################################
+
+def manifest_key(name,time_i,interval):
+  '''
+  Returns the manifest key of a region window
+  '''
+  return '{:s}/{:d}h/{:%Y%m%dT%H%MZ}'.format(name,interval,time_i)
+
+# manifest_record
+###################################
+
+def manifest_record(region,time_i,interval,fileout,args):
+  '''
+  Returns the manifest record of a window: its input files with their
+  modification time and size, region, product, GPM version and output
+  '''
+  inputs={}
+  for filename in window_inputs(time_i,interval,args.product):
+    inputs[filename]=[_catalog[filename]['mtime'],_catalog[filename]['size']]
+
+  return {'inputs':inputs,
+          'region':list(region),
+          'product':args.product,
+          'version':GPM_V,
+          'output':fileout,
+          'mode':args.output}
+
+# window_up_to_date
+###################################
+
+def window_up_to_date(manifest,name,region,time_i,interval,args):
+  '''
+  True if the manifest has the window done with the same region, product,
+  GPM version and output mode, its output is still there and its
+  input files have not changed since, as found in the catalog
+  '''
+  record=manifest.get(manifest_key(name,time_i,interval))
+  if record is None:
+    return False
+
+  if (record['region'] != list(region) or record['product'] != args.product or
+      record['version'] != GPM_V or record['mode'] != args.output or
+      not os.path.exists(record['output'])):
+    return False
+
+  inputs=window_inputs(time_i,interval,args.product)
+  if not inputs:
+    return False
+  for filename in inputs:
+    if record['inputs'].get(filename) != [_catalog[filename]['mtime'],_catalog[filename]['size']]:
+      return False
+
+  return True
+
+# window_inputs
+###################################
+
+def window_inputs(time_i,interval,product):
+  '''
+  Returns the daily files holding the frames of a window in the catalog
+  '''
+  time_f=time_i + datetime.timedelta(hours=interval)
+
+  return sorted(set(filename for frame,filename,index in catalog_frames(time_i,time_f,product)))
+
+# set_profile
+###################################
+
+def set_profile(enabled):
+  '''
+  Turns the recording of stages with profile_stage on or off, tracing
+  memory allocations with tracemalloc while on
+  '''
+  global profiling
+  profiling=enabled
+  if profiling and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+# profile_stage
+###################################
+
+@contextlib.contextmanager
+def profile_stage(stage,name='',time_i=None,interval=None):
+  '''
+  Records the wall time, peak memory traced and peak RSS of the stage run
+  within the context, for the region name (the file for 'close') and the day or window time_i
+  of the interval, in profile_records. Yields the record, where the
+  stage sets the bytes it reads and writes. Does nothing if not profiling.
+  Traced memory is the peak allocated since the stage started
+  '''
+  record={'stage':stage,'region':name,
+          'time':time_i.strftime('%Y%m%dT%H%MZ') if time_i is not None else '',
+          'interval':interval if interval is not None else '',
+          'bytes_read':0,'bytes_written':0}
+  if not profiling:
+    yield record
+    return
+
+  tracemalloc.clear_traces()
+  start=time.perf_counter()
+  try:
+    yield record
+  finally:
+    record['wall']=time.perf_counter()-start
+    record['peak_traced']=tracemalloc.get_traced_memory()[1]
+    # ru_maxrss is in kilobytes on Linux
+    record['max_rss']=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+    record['pid']=os.getpid()
+    profile_records.append(record)
+
+# take_profile_records
+###################################
+
+def take_profile_records():
+  '''
+  Returns the stages recorded so far and removes them from profile_records,
+  for the worker processes to hand them back to the main one
+  '''
+  records=profile_records[:]
+  del profile_records[:len(records)]
+
+  return records
+
+# write_profile
+###################################
+
+def write_profile(records,filename):
+  '''
+  Writes the stages recorded to filename, as CSV if it ends in .csv or as
+  a JSON list otherwise
+  '''
+  fields=['stage','region','time','interval','pid','wall','bytes_read',
+          'bytes_written','peak_traced','max_rss']
+
+  if filename.endswith('.csv'):
+    with open(filename,'w',newline='') as fileout:
+      writer=csv.DictWriter(fileout,fieldnames=fields)
+      writer.writeheader()
+      writer.writerows(records)
+  else:
+    with open(filename,'w') as fileout:
+      json.dump(records,fileout,indent=1)
+
+# print_profile
+###################################
+
+def print_profile(records):
+  '''
+  Prints a table with the number of calls, total and maximum wall time,
+  data read and written, throughput and peak memory of each stage
+  '''
+  MB=1024.*1024.
+  stages=[]
+  for record in records:
+    if record['stage'] not in stages:
+      stages.append(record['stage'])
+
+  print(' {:<9s}{:>7s}{:>10s}{:>9s}{:>10s}{:>10s}{:>9s}{:>11s}{:>9s}'.format(
+        'Stage','Calls','Total s','Max s','Read MB','Write MB','MB/s','Traced MB','RSS MB'))
+  for stage in stages:
+    stage_records=[record for record in records if record['stage'] == stage]
+    wall=sum(record['wall'] for record in stage_records)
+    read=sum(record['bytes_read'] for record in stage_records)/MB
+    written=sum(record['bytes_written'] for record in stage_records)/MB
+    print(' {:<9s}{:>7d}{:>10.3f}{:>9.3f}{:>10.1f}{:>10.1f}{:>9.1f}{:>11.1f}{:>9.1f}'.format(
+          stage,len(stage_records),wall,max(record['wall'] for record in stage_records),
+          read,written,(read+written)/wall if wall > 0 else 0.,
+          max(record['peak_traced'] for record in stage_records)/MB,
+          max(record['max_rss'] for record in stage_records)/MB))
+
+##########################################################################
+#                     I/O BACKENDS                                       #
+##########################################################################
+
+# iris_load_day
+###################################
+
+def iris_load_day(filename,region,frames=slice(None)):
+  '''
+  Reads the region and the frames (a slice of time indices) of a daily
+  file with Iris into a GPMField
+  '''
+  import iris
+
+  # Get cubes, data is not read until the region is cut-off
+  gpm=iris.load_cube(filename)
+  #Extract, only the lat/lon hyperslab of the region is read from disk
+  gpm=region_hyperslab(gpm,region)
+  lon_first=gpm.coord_dims('longitude')[0] < gpm.coord_dims('latitude')[0]
+  gpm.transpose([gpm.coord_dims(name)[0] for name in ('time','latitude','longitude')])
+  gpm=gpm[frames]
+
+  time=gpm.coord('time')
+  lat=gpm.coord('latitude')
+  lon=gpm.coord('longitude')
+  to_datetime=lambda t: datetime.datetime(*time.units.num2date(t).timetuple()[:6])
+
+  meta={'var_name':gpm.var_name,
+        'standard_name':gpm.standard_name,
+        'long_name':gpm.long_name,
+        'units':str(gpm.units),
+        'attributes':dict(gpm.attributes),
+        'time_var_name':time.var_name or 'time',
+        'time_units':str(time.units.origin),
+        'time_calendar':str(time.units.calendar),
+        'latitude_var_name':lat.var_name or 'latitude',
+        'latitude_units':str(lat.units),
+        'longitude_var_name':lon.var_name or 'longitude',
+        'longitude_units':str(lon.units),
+        'coord_system':lat.coord_system,
+        'lon_first':lon_first}
+
+  #Read the data now, the windows are cut from memory afterwards
+  return GPMField(gpm.data,
+                  [to_datetime(t) for t in time.points],
+                  lat.points,
+                  lon.points,
+                  time_bounds=[(to_datetime(b[0]),to_datetime(b[1])) for b in time.bounds] if time.has_bounds() else None,
+                  lat_bounds=lat.bounds,
+                  lon_bounds=lon.bounds,
+                  meta=meta)
+
+# region_hyperslab
+###################################
+
+def region_hyperslab(cube,region):
+  '''
+  Cuts-off the region of a lazy cube by indexing, so only the lat/lon
+  hyperslab is read from disk. Longitudes are returned within
+  [E, E+360) like cube.intersection does.
+  '''
+  import iris
+
+  lon=cube.coord('longitude')
+  lat_slice,lon_slices=region_slices(lon.points,cube.coord('latitude').points,region)
+
+  lon_dim=cube.coord_dims('longitude')[0]
+  lat_dim=cube.coord_dims('latitude')[0]
+
+  pieces=iris.cube.CubeList()
+  for lon_slice in lon_slices:
+    keys=[slice(None)]*cube.ndim
+    keys[lat_dim]=lat_slice
+    keys[lon_dim]=lon_slice
+    piece=cube[tuple(keys)]
+
+    # Shift longitudes of the piece into [E, E+360)
+    piece_lon=piece.coord('longitude')
+    shift=lon_shift(piece_lon.points,region)
+    if shift != 0:
+      piece_lon.points=piece_lon.points-shift
+      if piece_lon.has_bounds():
+        piece_lon.bounds=piece_lon.bounds-shift
+    piece_lon.circular=False
+    pieces.append(piece)
+
+  if len(pieces) == 1:
+    return pieces[0]
+
+  return pieces.concatenate_cube()
+
+# field_to_cube
+###################################
+
+def field_to_cube(field):
+  '''
+  Converts a GPMField into an Iris cube. Averaged windows get a scalar
+  time coordinate with bounds and a time mean cell method, as collapsing
+  the frames with Iris gives
+  '''
+  import iris.coords
+  import iris.cube
+  import cf_units
+
+  meta=field.meta
+  time_units=cf_units.Unit(meta['time_units'],calendar=meta['time_calendar'])
+
+  time=iris.coords.DimCoord(time_units.date2num(field.times),
+                            standard_name='time',
+                            var_name=meta['time_var_name'],
+                            units=time_units,
+                            bounds=None if field.time_bounds is None else
+                                   time_units.date2num(np.array(field.time_bounds)))
+  # Coordinates in double precision, as the windows cut with
+  # cube.intersection were saved
+  lat=iris.coords.DimCoord(np.asarray(field.lats,dtype='f8'),
+                           standard_name='latitude',
+                           var_name=meta['latitude_var_name'],
+                           units=meta['latitude_units'],
+                           bounds=None if field.lat_bounds is None else np.asarray(field.lat_bounds,dtype='f8'),
+                           coord_system=meta.get('coord_system'))
+  lon=iris.coords.DimCoord(np.asarray(field.lons,dtype='f8'),
+                           standard_name='longitude',
+                           var_name=meta['longitude_var_name'],
+                           units=meta['longitude_units'],
+                           bounds=None if field.lon_bounds is None else np.asarray(field.lon_bounds,dtype='f8'),
+                           coord_system=meta.get('coord_system'))
+
+  cube=iris.cube.Cube(field.data,
+                      standard_name=meta['standard_name'],
+                      long_name=meta['long_name'],
+                      var_name=meta['var_name'],
+                      units=meta['units'],
+                      attributes=meta['attributes'])
+  if field.data.ndim == 3:
+    cube.add_dim_coord(time,0)
+    cube.add_dim_coord(lat,1)
+    cube.add_dim_coord(lon,2)
+  else:
+    cube.add_aux_coord(time)
+    cube.add_dim_coord(lat,0)
+    cube.add_dim_coord(lon,1)
+    cube.add_cell_method(iris.coords.CellMethod('mean',coords='time'))
+
+  # Back to the order of the daily files
+  if meta.get('lon_first'):
+    cube.transpose(list(range(cube.ndim-2))+[cube.ndim-1,cube.ndim-2])
+
+  return cube
+
+# iris_save
+###################################
+
+def iris_save(field,fileout):
+  '''
+  Saves a GPMField to NetCDF with Iris
+  '''
+  import iris
+
+  iris.save(field_to_cube(field),fileout)
+
+# netcdf4_load_day
+###################################
+
+def netcdf4_load_day(filename,region,frames=slice(None)):
+  '''
+  Reads the region and the frames (a slice of time indices) of a daily
+  file with netCDF4 into a GPMField, only that hyperslab is read from disk
+  '''
+  with netCDF4.Dataset(filename,'r') as dataset:
+    return netcdf4_read_day(dataset,region,frames)
+
+# netcdf4_read_day
+###################################
+
+def netcdf4_read_day(dataset,region,frames=slice(None)):
+  '''
+  Reads the region and the frames of a daily file already open as a
+  netCDF4 dataset into a GPMField, see netcdf4_load_day
+  '''
+  nc_var,nc_time,nc_lat,nc_lon=netcdf4_find_variable(dataset)
+  lats=nc_lat[:].filled() if np.ma.isMaskedArray(nc_lat[:]) else nc_lat[:]
+  lons=nc_lon[:].filled() if np.ma.isMaskedArray(nc_lon[:]) else nc_lon[:]
+  lat_slice,lon_slices=region_slices(lons,lats,region)
+
+  # Axes of the variable, the raw IMERG files are (time, lon, lat)
+  axes=[nc_var.dimensions.index(nc.dimensions[0]) for nc in (nc_time,nc_lat,nc_lon)]
+  pieces=[]
+  piece_lons=[]
+  for lon_slice in lon_slices:
+    keys=[slice(None)]*3
+    keys[axes[0]]=frames
+    keys[axes[1]]=lat_slice
+    keys[axes[2]]=lon_slice
+    pieces.append(np.ma.asarray(nc_var[tuple(keys)]))
+    piece_lons.append(lons[lon_slice]-lon_shift(lons[lon_slice],region))
+  data=np.ma.concatenate(pieces,axis=axes[2]).transpose(axes)
+
+  calendar=getattr(nc_time,'calendar','standard')
+  to_datetime=lambda t: [datetime.datetime(*d.timetuple()[:6]) for d in
+                         netCDF4.num2date(t,nc_time.units,calendar)]
+  time_bounds=None
+  if getattr(nc_time,'bounds',None) in dataset.variables:
+    time_bounds=list(zip(*[to_datetime(b) for b in dataset.variables[nc_time.bounds][frames].T]))
+
+  meta={'var_name':nc_var.name,
+        'standard_name':getattr(nc_var,'standard_name',None),
+        'long_name':getattr(nc_var,'long_name',None),
+        'units':getattr(nc_var,'units','1'),
+        'attributes':dict((name,dataset.getncattr(name)) for name in dataset.ncattrs()
+                          if name != 'Conventions'),
+        'time_var_name':nc_time.name,
+        'time_units':nc_time.units,
+        'time_calendar':calendar,
+        'latitude_var_name':nc_lat.name,
+        'latitude_units':getattr(nc_lat,'units','degrees_north'),
+        'longitude_var_name':nc_lon.name,
+        'longitude_units':getattr(nc_lon,'units','degrees_east'),
+        'lon_first':axes[2] < axes[1]}
+
+  return GPMField(data,
+                  to_datetime(nc_time[frames]),
+                  lats[lat_slice],
+                  np.concatenate(piece_lons),
+                  time_bounds=time_bounds,
+                  meta=meta)
+
+# netcdf4_find_variable
+###################################
+
+def netcdf4_find_variable(dataset):
+  '''
+  Returns the rainfall variable of a daily file, the first one with time,
+  latitude and longitude dimensions, and its time, latitude and longitude
+  coordinate variables
+  '''
+  names={'time':('time',),'latitude':('lat','latitude'),'longitude':('lon','longitude')}
+  coords={}
+  for name,nc_var in dataset.variables.items():
+    if nc_var.ndim != 1 or nc_var.dimensions[0] != name:
+      continue
+    for coord in names:
+      if getattr(nc_var,'standard_name',None) == coord or name.lower() in names[coord]:
+        coords[coord]=nc_var
+
+  if len(coords) != 3:
+    raise ValueError("Time, latitude and longitude not found in {:s}".format(dataset.filepath()))
+
+  dims=set(coords[coord].dimensions[0] for coord in coords)
+  for nc_var in dataset.variables.values():
+    if nc_var.ndim == 3 and set(nc_var.dimensions) == dims:
+      return nc_var,coords['time'],coords['latitude'],coords['longitude']
+
+  raise ValueError("No rainfall variable found in {:s}".format(dataset.filepath()))
+
+# netcdf4_save
+###################################
+
+def netcdf4_save(field,fileout):
+  '''
+  Saves a GPMField window to NetCDF with netCDF4, in the same layout
+  iris_save writes
+  '''
+  meta=field.meta
+
+  with netCDF4.Dataset(fileout,'w',format='NETCDF4') as dataset:
+    dataset.Conventions='CF-1.7'
+    for name,value in meta['attributes'].items():
+      dataset.setncattr(name,value)
+
+    lat_name=meta['latitude_var_name']
+    lon_name=meta['longitude_var_name']
+    dataset.createDimension(lat_name,len(field.lats))
+    dataset.createDimension(lon_name,len(field.lons))
+    dataset.createDimension('bnds',2)
+
+    # In the order of the daily files
+    if meta.get('lon_first'):
+      nc_var=dataset.createVariable(meta['var_name'] or 'precipitation',field.data.dtype,(lon_name,lat_name))
+      nc_var[:]=field.data.T
+    else:
+      nc_var=dataset.createVariable(meta['var_name'] or 'precipitation',field.data.dtype,(lat_name,lon_name))
+      nc_var[:]=field.data
+    for name in ('standard_name','long_name','units'):
+      if meta[name]:
+        nc_var.setncattr(name,meta[name])
+    nc_var.cell_methods='time: mean'
+    nc_var.coordinates=meta['time_var_name']
+
+    for name,axis,points,bounds in ((lat_name,'Y',field.lats,field.lat_bounds),
+                                    (lon_name,'X',field.lons,field.lon_bounds)):
+      nc_coord=dataset.createVariable(name,'f8',(name,))
+      nc_coord.axis=axis
+      nc_coord.units=meta[('latitude' if axis == 'Y' else 'longitude')+'_units']
+      nc_coord.standard_name='latitude' if axis == 'Y' else 'longitude'
+      nc_coord[:]=points
+      if bounds is not None:
+        nc_coord.bounds=name+'_bnds'
+        dataset.createVariable(name+'_bnds','f8',(name,'bnds'))[:]=bounds
+
+    nc_time=dataset.createVariable(meta['time_var_name'],'f8',())
+    nc_time.bounds=meta['time_var_name']+'_bnds'
+    nc_time.units=meta['time_units']
+    nc_time.standard_name='time'
+    nc_time.calendar=meta['time_calendar']
+    nc_time.assignValue(netCDF4.date2num(field.times[0],meta['time_units'],meta['time_calendar']))
+    nc_bnds=dataset.createVariable(meta['time_var_name']+'_bnds','f8',('bnds',))
+    nc_bnds[:]=netCDF4.date2num(list(field.time_bounds[0]),meta['time_units'],meta['time_calendar'])
+
+# Backends to read the daily files and save the windows
+BACKENDS={'iris':{'load':iris_load_day,'save':iris_save},
+          'netcdf4':{'load':netcdf4_load_day,'save':netcdf4_save}}
 
 #                     END OF PROGRAM                                     #
 ##########################################################################
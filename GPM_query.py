@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+
+import netCDF4
+import numpy as np
+import datetime
+import argparse
+'''
+GPM_query returns the IMERG-GPM rainfall accumulated over any period from
+the cumulative sum store written by GPM_download.py --output cumsum, e.g.
+
+GPM_download.py --ini 20200101T0000Z --fin 20200331T0000Z --reg IO=40,-20,100,50 \
+          --prod production --output cumsum --dir $HOME/temp/
+
+The store keeps the rainfall accumulated since its first time at every
+half-hourly frame edge, so the accumulation between two times is the
+difference of two fields and the raw archive is not read again.
+
+How to call the script
+GPM_query.py --store $HOME/temp/IO/GPM_V06B_cumsum.nc \
+          --start 20200101T0730Z --end 20200101T1900Z --out $HOME/temp/acc.nc
+
+Start and end must be on the hour or half past the hour. The period takes
+the half-hourly frames start <= time < end.
+'''
+
+##########################################################################
+#                     MAIN PROGRAM                                       #
+##########################################################################
+def main():
+    '''
+    Prints the rainfall accumulated over the requested period and saves it
+    to a NetCDF file if requested
+    '''
+    # Parse command line arguments
+    args = parse_args()
+
+    acc,nframes,lats,lons=query_accumulation(args.store,args.start,args.end)
+
+    print('Accumulation {:%H%MZ %d/%m/%Y} to {:%H%MZ %d/%m/%Y}: mean {:.2f} mm, max {:.2f} mm'.format(
+          args.start,args.end,acc.mean(),acc.max()))
+
+    if args.fileout:
+      save_accumulation(args.fileout,acc,nframes,lats,lons,args.start,args.end)
+
+##########################################################################
+
+def parse_args():
+  '''Parses and returns command line arguments.'''
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+      description="Query GPM-IMERG accumulations from a cumulative sum store")
+
+  parser.add_argument("--store",
+                      type=str,
+                      help=("Cumulative sum store written by "
+                            "GPM_download.py --output cumsum"),
+                      required=True,
+                      dest="store")
+
+  parser.add_argument("--start",
+                      type=cycletime_to_datetime,
+                      help=("Start of the period in ISO8601 "
+                            "format YYYYmmddTHHMMZ"),
+                      required=True,
+                      dest="start")
+
+  parser.add_argument("--end",
+                      type=cycletime_to_datetime,
+                      help=("End of the period in ISO8601 "
+                            "format YYYYmmddTHHMMZ"),
+                      required=True,
+                      dest="end")
+
+  parser.add_argument("--out",
+                      type=str,
+                      help=("NetCDF file to save the accumulation"),
+                      default=None,
+                      dest="fileout")
+
+  return parser.parse_args()
+
+# cycletime_to_datetime
+###################################
+
+def cycletime_to_datetime(cycletime):
+  '''
+  Converts a cycletime string in ISO8601 format to a \
+  :class:`datetime.datetime` object.
+  '''
+  return datetime.datetime.strptime(cycletime, "%Y%m%dT%H%MZ")
+
+# query_accumulation
+###################################
+
+def query_accumulation(store,time_a,time_b):
+  '''
+  Returns the rainfall accumulated (mm) from time_a to time_b, the number
+  of valid half-hourly frames in the period and the latitudes and
+  longitudes of the store. Only the two fields at time_a and time_b are
+  read. Grid points without any valid frame are masked
+  '''
+  if time_b <= time_a:
+    raise ValueError("End of the period must be after its start")
+
+  with netCDF4.Dataset(store,'r') as dataset:
+    nc_time=dataset.variables['time']
+    edges=nc_time[:]
+
+    index=[]
+    for time_q in (time_a,time_b):
+      edge=netCDF4.date2num(time_q,nc_time.units,nc_time.calendar)
+      k=int(np.searchsorted(edges,edge))
+      if k == len(edges) or edges[k] != edge:
+        raise ValueError("{:%H%MZ %d/%m/%Y} not in {:s}, it must be a half-hourly time "
+                         "between {:s} and {:s}".format(time_q,store,
+                         *[str(t) for t in netCDF4.num2date(edges[[0,-1]],nc_time.units,nc_time.calendar)]))
+      index.append(k)
+
+    acc=dataset.variables['accumulation'][index[1]]-dataset.variables['accumulation'][index[0]]
+    nframes=dataset.variables['count'][index[1]]-dataset.variables['count'][index[0]]
+    lats=dataset.variables['latitude'][:]
+    lons=dataset.variables['longitude'][:]
+
+  acc=np.ma.masked_where(nframes == 0,acc)
+
+  return acc,nframes,lats,lons
+
+# save_accumulation
+###################################
+
+def save_accumulation(fileout,acc,nframes,lats,lons,time_a,time_b):
+  '''
+  Saves the accumulation, the mean rate over the valid frames and the
+  number of valid frames of the period to a NetCDF file
+  '''
+  with netCDF4.Dataset(fileout,'w',format='NETCDF4') as dataset:
+    dataset.Conventions='CF-1.7'
+    dataset.createDimension('latitude',len(lats))
+    dataset.createDimension('longitude',len(lons))
+    dataset.createDimension('bnds',2)
+
+    nc_time=dataset.createVariable('time','f8',())
+    nc_time.units='minutes since 1970-01-01 00:00:00'
+    nc_time.standard_name='time'
+    nc_time.bounds='time_bnds'
+    nc_bnds=dataset.createVariable('time_bnds','f8',('bnds',))
+    nc_bnds[:]=netCDF4.date2num([time_a,time_b],nc_time.units)
+    nc_time.assignValue(nc_bnds[:].mean())
+
+    for name,points in (('latitude',lats),('longitude',lons)):
+      nc_coord=dataset.createVariable(name,'f4',(name,))
+      nc_coord[:]=points
+      nc_coord.standard_name=name
+      nc_coord.units='degrees_north' if name == 'latitude' else 'degrees_east'
+
+    fill_value=np.float32(netCDF4.default_fillvals['f4'])
+    nc_acc=dataset.createVariable('accumulation','f4',('latitude','longitude'),fill_value=fill_value)
+    nc_acc[:]=acc
+    nc_acc.units='mm'
+    nc_acc.cell_methods='time: sum'
+
+    nc_rate=dataset.createVariable('precipitation','f4',('latitude','longitude'),fill_value=fill_value)
+    nc_rate[:]=acc/(0.5*np.ma.masked_equal(nframes,0))
+    nc_rate.units='mm/hr'
+    nc_rate.cell_methods='time: mean'
+
+    nc_count=dataset.createVariable('count','i4',('latitude','longitude'))
+    nc_count[:]=nframes
+    nc_count.long_name='number of valid half-hourly frames'
+
+#                     END OF PROGRAM                                     #
+##########################################################################
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+import GPM_download
+import numpy as np
+import collections
+import datetime
+import argparse
+import http.server
+import io
+import os
+import socketserver
+import tempfile
+import threading
+import urllib.parse
+'''
+GPM_server serves IMERG-GPM rainfall accumulations over a local HTTP
+endpoint, so jobs needing many small boxes do not start GPM_download.py
+(and import IRIS) for each of them. It reads a local directory of daily
+IMERG files laid out as the archive of GPM_download.py, with no outside
+services.
+
+How to call the script
+GPM_server.py --gpm-path $HOME/imerg/ --port 8000
+
+and request a window, as GPM_download.py --reg --ini --int --prod would
+save it, with
+curl -o acc.nc "http://localhost:8000/accumulation?region=40,-20,100,50&start=20200101T0000Z&interval=3&product=production"
+
+Add &format=npz to get the raw arrays instead of a NetCDF file, an npz
+with the mean rain rate 'data' (NaN where there are no data), 'latitude',
+'longitude' and the window 'time_bounds' in ISO8601.
+
+The daily files last read are kept open (--files) and the windows last
+served are kept in memory up to --cache-mb, they are served again without
+reading the files unless these have changed since.
+'''
+
+# Windows served, {(region, start, interval, product, inputs): field}
+results=collections.OrderedDict()
+results_lock=threading.Lock()
+results_max_bytes=256*1024*1024
+
+# Daily files open, {filename: (mtime, size, dataset)}
+open_files=collections.OrderedDict()
+open_files_max=8
+
+##########################################################################
+#                     MAIN PROGRAM                                       #
+##########################################################################
+def main():
+    '''
+    Serves the GPM accumulations until interrupted
+    '''
+    global results_max_bytes,open_files_max
+
+    # Parse command line arguments
+    args = parse_args()
+
+    GPM_download.set_gpm_path(args.gpm_path)
+    results_max_bytes=int(args.cache_mb*1024*1024)
+    open_files_max=args.files
+
+    server=ThreadingHTTPServer((args.host,args.port),GPMRequestHandler)
+    print('Serving GPM accumulations from {:s} at http://{:s}:{:d}/accumulation'.format(
+          args.gpm_path,args.host,args.port))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    server.server_close()
+
+    with GPM_download.netcdf_lock:
+      for mtime,size,dataset in open_files.values():
+        dataset.close()
+
+##########################################################################
+
+def parse_args():
+  '''Parses and returns command line arguments.'''
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+      description="Serve GPM-IMERG accumulations over HTTP")
+
+  parser.add_argument("--gpm-path",
+                      type=str,
+                      help=("Local directory of daily IMERG files, laid "
+                            "out as the archive of GPM_download.py"),
+                      required=True,
+                      dest="gpm_path")
+
+  parser.add_argument("--host",
+                      type=str,
+                      help=("Address to listen at"),
+                      default="127.0.0.1",
+                      dest="host")
+
+  parser.add_argument("--port",
+                      type=int,
+                      help=("Port to listen at"),
+                      default=8000,
+                      dest="port")
+
+  parser.add_argument("--files",
+                      type=int,
+                      help=("Number of daily files kept open"),
+                      default=8,
+                      dest="files")
+
+  parser.add_argument("--cache-mb",
+                      type=float,
+                      help=("Memory for the windows last served in MB, "
+                            "the least recently used are dropped beyond it"),
+                      default=256.,
+                      dest="cache_mb")
+
+  return parser.parse_args()
+
+# ThreadingHTTPServer
+###################################
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,http.server.HTTPServer):
+  '''
+  HTTP server answering each request in its own thread, as
+  http.server.ThreadingHTTPServer does from Python 3.7
+  '''
+  daemon_threads=True
+
+# GPMRequestHandler
+###################################
+
+class GPMRequestHandler(http.server.BaseHTTPRequestHandler):
+  '''
+  Answers GET /accumulation?region=E,S,W,N&start=YYYYmmddTHHMMZ&interval=H
+  &product=P[&format=netcdf|npz] with the window as GPM_download.py saves it
+  '''
+  def do_GET(self):
+    url=urllib.parse.urlparse(self.path)
+    if url.path != '/accumulation':
+      self.send_error(404,"Unknown path, use /accumulation")
+      return
+
+    try:
+      query=dict((key,values[-1]) for key,values in urllib.parse.parse_qs(url.query).items())
+      region=GPM_download.region_str_to_list(query['region'])
+      start=GPM_download.cycletime_to_datetime(query['start'])
+      interval=int(query['interval'])
+      product=query.get('product','production')
+      fmt=query.get('format','netcdf')
+      if fmt not in ('netcdf','npz'):
+        raise ValueError("format must be 'netcdf' or 'npz'")
+      # Region, interval and product as GPM_download.py takes them
+      GPM_download.check_args([interval],[('',region)],product)
+    except (KeyError,ValueError,argparse.ArgumentTypeError) as exc:
+      self.send_error(400,"Bad request: {:s}".format(str(exc)))
+      return
+
+    try:
+      field=get_window(region,start,interval,product)
+      if fmt == 'netcdf':
+        body=field_to_netcdf(field)
+        content_type='application/x-netcdf'
+      else:
+        body=field_to_npz(field)
+        content_type='application/octet-stream'
+    except FileNotFoundError as exc:
+      self.send_error(404,str(exc))
+      return
+    except ValueError as exc:
+      # A region without points of the grid, or a window without frames
+      self.send_error(400,"Bad request: {:s}".format(str(exc)))
+      return
+    except Exception as exc:
+      self.send_error(500,str(exc))
+      return
+
+    self.send_response(200)
+    self.send_header('Content-Type',content_type)
+    self.send_header('Content-Length',str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+# get_window
+###################################
+
+def get_window(region,start,interval,product):
+  '''
+  Returns the window as a GPMField from the results already served if its
+  input files have not changed since, otherwise with get_gpm_cubes from
+  the daily files kept open
+  '''
+  time_f=start + datetime.timedelta(hours=interval)
+  GPM_download.update_catalog(start,time_f,product)
+  inputs=tuple((filename,GPM_download._catalog[filename]['mtime'],GPM_download._catalog[filename]['size'])
+               for filename in GPM_download.window_inputs(start,interval,product))
+  key=(tuple(region),start,interval,product,inputs)
+
+  with results_lock:
+    if key in results:
+      results.move_to_end(key)
+      return results[key]
+
+  field=GPM_download.get_gpm_cubes(start,region,interval,product,backend='open_files')
+
+  with results_lock:
+    results[key]=field
+    # Least recently served first
+    while sum(cached.data.nbytes for cached in results.values()) > results_max_bytes and len(results) > 1:
+      results.popitem(last=False)
+
+  return field
+
+# open_load_day
+###################################
+
+def open_load_day(filename,region,frames=slice(None)):
+  '''
+  Load function of the 'open_files' backend, reads the region and the
+  frames of a daily file as netcdf4_load_day does, keeping the file open
+  for the next requests. Called with GPM_download.netcdf_lock held
+  '''
+  stat=os.stat(filename)
+  if filename in open_files:
+    mtime,size,dataset=open_files.pop(filename)
+    if (mtime,size) != (stat.st_mtime,stat.st_size):
+      # Refreshed since it was opened
+      dataset.close()
+      dataset=GPM_download.netCDF4.Dataset(filename,'r')
+  else:
+    dataset=GPM_download.netCDF4.Dataset(filename,'r')
+  open_files[filename]=(stat.st_mtime,stat.st_size,dataset)
+
+  while len(open_files) > open_files_max:
+    mtime,size,oldest=open_files.popitem(last=False)[1]
+    oldest.close()
+
+  return GPM_download.netcdf4_read_day(dataset,region,frames)
+
+# field_to_netcdf
+###################################
+
+def field_to_netcdf(field):
+  '''
+  Returns the window saved as a NetCDF file, as GPM_download.py saves it
+  with --backend netcdf4
+  '''
+  handle,fileout=tempfile.mkstemp(suffix='.nc')
+  os.close(handle)
+  try:
+    with GPM_download.netcdf_lock:
+      GPM_download.netcdf4_save(field,fileout)
+    with open(fileout,'rb') as f:
+      return f.read()
+  finally:
+    os.remove(fileout)
+
+# field_to_npz
+###################################
+
+def field_to_npz(field):
+  '''
+  Returns the window data, NaN where masked, latitudes, longitudes and
+  time bounds in ISO8601 as an npz file
+  '''
+  buffer=io.BytesIO()
+  np.savez(buffer,
+           data=np.ma.filled(field.data.astype('f4'),np.nan),
+           latitude=field.lats,
+           longitude=field.lons,
+           time_bounds=np.array([t.strftime('%Y-%m-%dT%H:%M:%S') for t in field.time_bounds[0]]))
+
+  return buffer.getvalue()
+
+# Daily files read from those kept open, windows saved as netcdf4 does
+GPM_download.BACKENDS['open_files']={'load':open_load_day,
+                                     'save':GPM_download.netcdf4_save}
+
+#                     END OF PROGRAM                                     #
+##########################################################################
+if __name__ == '__main__':
+    main()
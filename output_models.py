@@ -1,88 +1,467 @@
-import os
 import datetime
+import argparse
+import os
+import sqlite3
+import json
+import multiprocessing
+import collections
 
 cyclone='HAGIBIS'
+database='global_coupled_NWP.html'
+
+# Bytes of database parsed by each task with --workers, at most two per
+# worker are held parsed at once
+chunk_size=4*1024*1024
+
+# Column of the storm name in the records of the database, counted as
+# data=line[4:].split(). The columns read from a record are
+#   data[2:6] time (YYYY mm dd HH), data[6] lead time (Tp, **** if none),
+#   data[10:12] lat, lon and data[20:22] pmsl, wind speed,
+# the name is not read, the lines were picked by grep. It is taken as the
+# column just before the time, and --all stops at a record without a
+# name there rather than sending its rows to a wrong storm
+name_col=1
 
 ##########################################################################
 #                           MAIN PROGRAM                                 #
 ##########################################################################
 def main():
 
-  # extract obs for given cyclone
-  os.system("grep "+cyclone.upper()+" global_coupled_NWP.html > cyclone_model.txt")
+  args=parse_args()
+
+  # From the indexed store, bringing it up to date with the database first
+  if args.store:
+    ingest_store(args.store,args.database,args.storms)
+    for storm in args.storms or store_storms(args.store):
+      write_store_storm(args.store,storm,args.init)
+    return
+
+  # Forecast state of every storm found, {STORM: state}, and the bytes of
+  # the database to read. With --state from where the last run stopped
+  storms={}
+  start=0
+  end=None
+  if args.state:
+    storms,start=read_state(args.state,args.database,args.storms)
+    end=complete_size(args.database)
+
+  # Read the database once, sending every record to its storm in order
+  if args.workers > 1:
+    records=parallel_records(args.database,start,end,args.storms,args.workers)
+  else:
+    records=database_records(args.database,start,end,args.storms)
+  for storm,record in records:
+    if storm not in storms:
+      storms[storm]=new_state()
+    add_record(storm,storms[storm],record)
+
+  if args.storms is None and not storms:
+    raise ValueError("No storm records found in "+args.database+", check name_col")
+
+  if args.state:
+    write_state(args.state,args.database,args.storms,storms,end)
+
+##########################################################################
+#                           AUXILIARY PROGRAM                            #
+##########################################################################
+
+def parse_args():
 
-  times,Tp,lon,lat,pmsl,spd=set_arrays()
+  parser=argparse.ArgumentParser(
+      description="Write the forecast tracks of the global coupled model "
+                  "from the database, one glm_cpl_<init>_<STORM> file per forecast")
 
-  #Initialize Tp_last
-  Tp_last='-6'
-  No_storm=True
+  parser.add_argument("--storms",
+                      type=lambda names: [name.upper() for name in names.split(',')],
+                      help=("Storm(s) to extract, comma separated. "
+                            "Default "+cyclone),
+                      default=[cyclone.upper()],
+                      dest="storms")
 
-  #Get time
-  f=open('cyclone_model.txt','r')
-  for i in f.readlines():
+  parser.add_argument("--all",
+                      action="store_const",
+                      const=None,
+                      help=("Extract every storm of the database, named by "
+                            "the column before the time of the records (name_col)"),
+                      dest="storms")
+
+  parser.add_argument("--database",
+                      type=str,
+                      help=("Database of forecasts. Default "+database),
+                      default=database,
+                      dest="database")
+
+  parser.add_argument("--workers",
+                      type=int,
+                      help=("Processes parsing chunks of the database in "
+                            "parallel. Default 1"),
+                      default=1,
+                      dest="workers")
+
+  parser.add_argument("--state",
+                      type=str,
+                      help=("JSON file keeping the bytes of the database read "
+                            "and the forecasts still open. Only the lines added "
+                            "since the last run are read"),
+                      default=None,
+                      dest="state")
+
+  parser.add_argument("--store",
+                      type=str,
+                      help=("SQLite store of the forecasts. Lines added to the "
+                            "database since the last run are ingested into it, "
+                            "then the forecasts of the storms are written from it. "
+                            "With --storms the records of a storm are those of "
+                            "the lines containing its name, as without --store. "
+                            "The store keeps one record per storm, initial time "
+                            "and lead time, and writes one file per initial time, "
+                            "the last forecast of a storm too. Without --store "
+                            "a forecast ends where the lead time stops growing, "
+                            "its file is named after the initial time of its "
+                            "last record and the last forecast is not written"),
+                      default=None,
+                      dest="store")
+
+  parser.add_argument("--init",
+                      type=lambda init: datetime.datetime.strptime(init,'%Y%m%d%H'),
+                      help=("With --store, write only the forecast initialised "
+                            "at this time, YYYYmmddHH"),
+                      default=None,
+                      dest="init")
+
+  return parser.parse_args()
+
+################################################
+
+def line_storms(line,data,storms):
+
+  # Storms given, the lines containing their names (as grep does)
+  if storms is not None:
+    return [storm for storm in storms if storm in line]
+
+  # Every storm, the name of the records, the lines with a time in data[2:6]
+  # (see name_col)
+  if len(data) > 6 and all(value.isdigit() for value in data[2:6]):
+    name=data[name_col]
+    if name.isdigit() or not name.replace('-','').isalnum():
+      raise ValueError("No storm name in column "+str(name_col)+" of the record '"+line.strip()+
+                       "', check name_col or give the storms with --storms")
+    return [name.upper()]
+
+  return []
+
+################################################
+
+def database_records(database,start,end,storms):
+
+  # Yields the (storm, record) records of the lines of the database
+  # starting in bytes [start, end), to the end of the file if end is None
+  f=open(database,'rb')
+  f.seek(start)
+  offset=start
+  for i in f:
+    if end is not None and offset >= end:
+      break
+    offset=offset+len(i)
     data=i[4:].split()
+    for storm in line_storms(i,data,storms):
+      yield storm,line_record(data)
+  f.close()
+
+################################################
+
+def line_record(data):
+
+  # The fields of a line kept: time (YYYYmmddHH), Tp, lat, lon, pmsl, spd,
+  # only Tp for the lines without forecast ('****')
+  if data[-1] == '****':
+    return (None,data[6])
+
+  return (data[2]+data[3]+data[4]+data[5],data[6],data[10],data[11],data[20],data[21])
+
+################################################
+
+def chunk_records(chunk):
+
+  # Returns the records of a (database, start, end, storms) chunk as a
+  # list, a task of the pool
+  return list(database_records(*chunk))
+
+################################################
+
+def chunk_starts(database,start,end,chunks):
+
+  # Returns the offsets of the first line starting after every
+  # (end-start)/chunks bytes of the database, from start
+  starts=[start]
+  f=open(database,'rb')
+  for n in range(1,chunks):
+    f.seek(max(start+n*(end-start)//chunks,starts[-1]))
+    f.readline()
+    if f.tell() < end and f.tell() > starts[-1]:
+      starts.append(f.tell())
+  f.close()
+
+  return starts
+
+################################################
+
+def parallel_records(database,start,end,storms,workers):
+
+  # Yields the (storm, data) records of the database in bytes [start, end)
+  # in order, the lines parsed in chunks by a pool of processes
+  size=os.path.getsize(database) if end is None else end
+  chunks=max(workers,(size-start)//chunk_size+1)
+  starts=chunk_starts(database,start,size,chunks)
+  tasks=[(database,first,last,storms) for first,last in zip(starts,starts[1:]+[end])]
+
+  # At most two chunks per worker parsed ahead of the records used
+  pool=multiprocessing.Pool(workers)
+  results=collections.deque()
+  for task in tasks:
+    results.append(pool.apply_async(chunk_records,(task,)))
+    if len(results) >= 2*workers:
+      for record in results.popleft().get():
+        yield record
+  while results:
+    for record in results.popleft().get():
+      yield record
+  pool.close()
+  pool.join()
+
+################################################
+
+def complete_size(database):
+
+  # Returns the bytes of the database up to the end of its last complete
+  # line, a last line still being written is left for the next run
+  f=open(database,'rb')
+  f.seek(0,2)
+  size=f.tell()
+  while size > 0:
+    f.seek(max(size-4096,0))
+    block=f.read(size-max(size-4096,0))
+    if '\n' in block:
+      size=size-len(block)+block.rindex('\n')+1
+      break
+    size=size-len(block)
+  f.close()
+
+  return size
+
+################################################
+
+def read_state(state_file,database,storms):
+
+  # Returns the forecast state of the storms and the offset of the database
+  # read by the last run, none if it read another database, other storms,
+  # or the database is now shorter (rewritten)
+  if not os.path.exists(state_file):
+    return {},0
+
+  f=open(state_file,'r')
+  saved=json.load(f)
+  f.close()
+  if (saved['database'] != os.path.abspath(database) or saved['storms'] != storms or
+      saved['offset'] > os.path.getsize(database)):
+    return {},0
+
+  states={}
+  for storm,state in saved['states'].items():
+    states[str(storm)]={'Tp_last':str(state['Tp_last']),
+                        'No_storm':state['No_storm'],
+                        'fcst_init':state['fcst_init'] and datetime.datetime.strptime(state['fcst_init'],'%Y%m%d%H'),
+                        'rows':[tuple(str(value) for value in row) for row in state['rows']]}
+
+  return states,saved['offset']
+
+################################################
+
+def write_state(state_file,database,storms,states,offset):
+
+  # Saves the forecast state of the storms and the offset of the database
+  # read, replacing the file at once
+  saved={'database':os.path.abspath(database),
+         'storms':storms,
+         'offset':offset,
+         'states':{}}
+  for storm,state in states.items():
+    saved['states'][storm]={'Tp_last':state['Tp_last'],
+                            'No_storm':state['No_storm'],
+                            'fcst_init':state['fcst_init'] and state['fcst_init'].strftime('%Y%m%d%H'),
+                            'rows':state['rows']}
+
+  f=open(state_file+'.tmp','w')
+  json.dump(saved,f)
+  f.close()
+  os.rename(state_file+'.tmp',state_file)
+
+################################################
+
+def new_state():
+
+    #Initialize Tp_last, rows of the forecast as in the database
+    return {'Tp_last':'-6',
+            'No_storm':True,
+            'fcst_init':None,
+            'rows':[]}
+
+################################################
+
+def add_record(storm,state,record):
+
     #Save storm at the from previous forecast if is new or lower than previous one
     # and reset arrays
     # If there is a forecast save it!
-    if data[-1] !='****':
-        save=get_cond_save(Tp_last,data[6],No_storm)
+    if record[0] is not None:
+        save=get_cond_save(state['Tp_last'],record[1],state['No_storm'])
         if save:
-            print '++++ '+data[6],Tp_last
-            print_storm(fcst_init,times,Tp,lon,lat,pmsl,spd)
-            times,lon,lat,Tp,pmsl,spd=set_arrays()
+            print '++++ '+record[1],state['Tp_last']
+            print_storm(storm,state['fcst_init'],state['rows'])
+            state['rows']=[]
 
-        time_TC=datetime.datetime.strptime(data[2]+data[3]+data[4]+data[5],'%Y%m%d%H')
-        Tp_init=int(data[6])
-        fcst_init=time_TC - datetime.timedelta(hours=Tp_init)
-        print '--',fcst_init,data[6],save,No_storm
-        #Copy variables to array
-        times.append(datetime.datetime.strptime(data[2]+data[3]+data[4]+data[5],'%Y%m%d%H'))
-        Tp.append(data[6])
-        lat.append(data[10])
-        lon.append(data[11])
-        pmsl.append(data[20])
-        spd.append(data[21])
+        time_TC=datetime.datetime.strptime(record[0],'%Y%m%d%H')
+        Tp_init=int(record[1])
+        state['fcst_init']=time_TC - datetime.timedelta(hours=Tp_init)
+        print '--',state['fcst_init'],record[1],save,state['No_storm']
+        #Copy variables to the rows: time, Tp, lat, lon, pmsl, spd
+        state['rows'].append(record)
 
         #Set Logical to true
-        No_storm=False
+        state['No_storm']=False
 
     # Keep record of last forecasts
-    Tp_last=data[6]
+    state['Tp_last']=record[1]
+
+################################################
+
+def open_store(store):
 
+  connection=sqlite3.connect(store)
+  connection.text_factory=str
+  connection.execute('CREATE TABLE IF NOT EXISTS tracks '
+                     '(storm TEXT, init TEXT, Tp INTEGER, time TEXT, '
+                     'lat TEXT, lon TEXT, pmsl TEXT, spd TEXT, '
+                     'UNIQUE (storm, init, Tp))')
+  connection.execute('CREATE TABLE IF NOT EXISTS ingested '
+                     '(database TEXT, storms TEXT, offset INTEGER, '
+                     'PRIMARY KEY (database, storms))')
 
+  return connection
+
+################################################
+
+def ingest_store(store,database,storms):
+
+  # Adds the records of the storms (every one if None, see line_storms) in
+  # the database past the offset ingested last time for them to the store,
+  # keyed by storm, forecast initial time and lead time. A record seen again
+  # replaces the one stored. Returns the number of records read
+  connection=open_store(store)
+  name=os.path.abspath(database)
+  key=','.join(sorted(storms)) if storms is not None else ''
+  row=connection.execute('SELECT offset FROM ingested WHERE database=? AND storms=?',(name,key)).fetchone()
+  offset=row[0] if row else 0
+  # Database shorter than ingested, rewritten rather than appended
+  if offset > os.path.getsize(database):
+    offset=0
+
+  # Rows streamed into the table, the offset read kept as they go
+  read={'offset':offset,'rows':0}
+  f=open(database,'rb')
+  f.seek(offset)
+  connection.executemany('INSERT OR REPLACE INTO tracks VALUES (?,?,?,?,?,?,?,?)',store_rows(f,storms,read))
   f.close()
-  os.system("rm -f cyclone_model.txt")
+  connection.execute('INSERT OR REPLACE INTO ingested VALUES (?,?,?)',(name,key,read['offset']))
+  connection.commit()
+  connection.close()
 
-##########################################################################
-#                           AUXILIARY PROGRAM                            #
-##########################################################################
+  return read['rows']
+
+################################################
+
+def store_rows(f,storms,read):
+
+  # Yields the rows of the store from the records of the storms in the
+  # database file from where it is, counting in read the rows and the
+  # offset reached
+  for i in f:
+    # Last line still being written, left for next time
+    if not i.endswith('\n'):
+      break
+    read['offset']=read['offset']+len(i)
+    data=i[4:].split()
+    for storm in line_storms(i,data,storms):
+      if data[-1] !='****':
+        time_TC=datetime.datetime.strptime(data[2]+data[3]+data[4]+data[5],'%Y%m%d%H')
+        fcst_init=time_TC - datetime.timedelta(hours=int(data[6]))
+        read['rows']=read['rows']+1
+        yield (storm,fcst_init.strftime('%Y%m%d%H'),int(data[6]),time_TC.strftime('%Y%m%d%H'),
+               data[10],data[11],data[20],data[21])
+
+################################################
+
+def query_store(store,storm,init=None,Tp=None):
+
+  # Returns the records of the storm ordered by forecast initial time and
+  # lead time, as (init, Tp, time, lat, lon, pmsl, spd) with the times as
+  # datetimes, of a single forecast and lead time if given
+  query='SELECT init,Tp,time,lat,lon,pmsl,spd FROM tracks WHERE storm=?'
+  values=[storm.upper()]
+  if init is not None:
+    query=query+' AND init=?'
+    values.append(init.strftime('%Y%m%d%H'))
+  if Tp is not None:
+    query=query+' AND Tp=?'
+    values.append(int(Tp))
+
+  connection=open_store(store)
+  rows=connection.execute(query+' ORDER BY init,Tp',values).fetchall()
+  connection.close()
+
+  return [(datetime.datetime.strptime(row[0],'%Y%m%d%H'),row[1],
+           datetime.datetime.strptime(row[2],'%Y%m%d%H'))+tuple(row[3:]) for row in rows]
+
+################################################
+
+def store_storms(store):
+
+  connection=open_store(store)
+  storms=[row[0] for row in connection.execute('SELECT DISTINCT storm FROM tracks ORDER BY storm')]
+  connection.close()
+
+  return storms
+
+################################################
 
-def set_arrays():
+def write_store_storm(store,storm,init=None):
 
-    times=[]
-    Tp=[]
-    lon=[]
-    lat=[]
-    pmsl=[]
-    spd=[]
+  # Writes a glm_cpl_<init>_<STORM> file for every forecast of the storm in
+  # the store
+  forecasts={}
+  for row in query_store(store,storm,init):
+    forecasts.setdefault(row[0],[]).append(row[1:])
 
-    return times,Tp,lon,lat,pmsl,spd
+  for fcst_init in sorted(forecasts):
+    rows=[(time.strftime('%Y%m%d%H'),Tp,lat,lon,pmsl,spd)
+          for Tp,time,lat,lon,pmsl,spd in forecasts[fcst_init]]
+    print_storm(storm,fcst_init,rows)
 
 ################################################
 
-def print_storm(fcst_init,times,Tp,lon,lat,pmsl,spd):
+def print_storm(storm,fcst_init,rows):
 
-  #### Print storms
-  outfile = open('glm_cpl_'+fcst_init.strftime('%Y%m%d%H')+'_'+cyclone.upper(),"w+")
-  for t,time in enumerate(times):
-    if time.year >= 2016:
+  #### Print storms, the strings of the database as they are
+  outfile = open('glm_cpl_'+fcst_init.strftime('%Y%m%d%H')+'_'+storm.upper(),"w+")
+  for time,Tp,lat,lon,pmsl,spd in rows:
+    if int(time[0:4]) >= 2016:
 # Example of format:
 #    1200UTC 09.08.2019   12  27.3N 122.0E      945            70
-      tshow=time.strftime('%H%MUTC %d.%m.%Y')
-      fcst='{: >3}'.format(Tp[t])
-      lat_lon='{: >5}'.format(lat[t])+' '+'{0: >6}'.format(lon[t])
-      p_show='{: >4}'.format(pmsl[t])
-      s_show='{: >3}'.format(spd[t])
+      tshow=time[8:10]+'00UTC '+time[6:8]+'.'+time[4:6]+'.'+time[0:4]
+      fcst='{: >3}'.format(Tp)
+      lat_lon='{: >5}'.format(lat)+' '+'{0: >6}'.format(lon)
+      p_show='{: >4}'.format(pmsl)
+      s_show='{: >3}'.format(spd)
       outfile.write(' '*4+tshow+' '*2+fcst+' '*2+lat_lon+' '*5+p_show+' '*11+s_show+'\n')
 
   outfile.close()
@@ -1,10 +1,19 @@
 import numpy as np
+import matplotlib
+# No display needed, the figures are only saved
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import cartopy
 
 import cartopy.feature as cfeature
 import datetime
+import collections
+import os
+import argparse
+import multiprocessing
+import time
+import tracks
 
 storm='YUTU'
 days_to_pick=['21/10/2018', '2/11/2018']
@@ -21,6 +30,17 @@ coastline = cfeature.NaturalEarthFeature(   category='Physical',
                                               scale='50m',
                                               facecolor='none')
 
+# Days to pick of each storm (first and last), other storms take the
+# days of their OBS track. --days sets them for all the storms plotted
+# and plots them again, even if their figures are up to date
+storm_days={storm:days_to_pick}
+replot_storms=set()
+
+# Tracks read, shared by all the panels and dates,
+# {(job, date (None for OBS), storm, mtime): track}, least recently used first
+track_cache=collections.OrderedDict()
+track_cache_size=64
+
 days_marker={'1':['x'],'2':['<'],'3':['d'],'4':['8'],'5':['p'],'6':['+'],'7':['.'],'6':['x'],'8':['<'],'9':['d'],'10':['>'],'11':['*'],'12':['^'],'13':['s'],
 '14':['8'],'15':['p'],'16':['+'],'17':['.'],'18':['x'],'19':['<'],'20':['d'],'21':['>'],'22':['*'],'23':['^'],'24':['s'],'25':['x'],'26':['<'],'27':['d'],'28':['>'],
 '29':['*'],'30':['^'],'31':['s']
@@ -32,33 +52,156 @@ days_marker={'1':['x'],'2':['<'],'3':['d'],'4':['8'],'5':['p'],'6':['+'],'7':['.
 ##########################################################################
 def main():
 
-  for date in dates:
-    do_TC_plot(date)
+  args=parse_args()
+  if args.days:
+    for storm in args.storms:
+      storm_days[storm]=args.days
+      replot_storms.add(storm)
+
+  # Figures of every storm and date, the dates of a storm together
+  # so a worker reuses the OBS track
+  figures=[(storm,date) for storm in args.storms for date in args.dates]
+  start=time.time()
+  if args.workers > 1:
+    pool=multiprocessing.Pool(args.workers)
+    results=pool.map(render_figure,figures)
+    pool.close()
+    pool.join()
+  else:
+    results=[render_figure(figure) for figure in figures]
+
+  print_timing(results,time.time()-start)
 
 ##########################################################################
 #                           AUX. PROGRAMS                                #
 ##########################################################################
 
-def do_TC_plot(date):
+def parse_args():
+
+  parser=argparse.ArgumentParser(
+      description="Plot the trajectory, PMSL and wind speed of the TC forecasts")
+
+  parser.add_argument("--storms",
+                      type=lambda names: [name.upper() for name in names.split(',')],
+                      help=("Storm(s) to plot, comma separated. Default "+storm),
+                      default=[storm],
+                      dest="storms")
+
+  parser.add_argument("--dates",
+                      type=lambda values: values.split(','),
+                      help=("Forecast dates to plot, YYYYmmdd comma separated. "
+                            "Default "+dates[0]+" to "+dates[-1]),
+                      default=dates,
+                      dest="dates")
+
+  parser.add_argument("--days",
+                      type=lambda values: values.split(','),
+                      help=("First and last days to plot of every storm, "
+                            "dd/mm/YYYY,dd/mm/YYYY. Default those of the OBS "
+                            "track, "+days_to_pick[0]+" to "+days_to_pick[1]+" for "+storm),
+                      default=None,
+                      dest="days")
+
+  parser.add_argument("--workers",
+                      type=int,
+                      help=("Processes rendering the figures. Default 1"),
+                      default=1,
+                      dest="workers")
+
+  args=parser.parse_args()
+
+  if args.days and len(args.days) != 2:
+    parser.error("--days takes the first and last days, dd/mm/YYYY,dd/mm/YYYY")
+
+  return args
+
+# render_figure
+#
+# Plots the figure of a (storm, date) unless its plot is newer
+# than all its track files and its days are not set with --days.
+# Returns storm, date, status and seconds,
+# a figure failing does not stop the others
+###########################################################
+
+def render_figure(figure):
+
+  storm,date=figure
+  start=time.time()
+
+  inputs=[track_file(storm,date,job) for job in jobs]
+  if not all(os.path.exists(filename) for filename in inputs):
+    status='missing'
+  elif (storm not in replot_storms and os.path.exists(plot_file(storm,date)) and
+        os.path.getmtime(plot_file(storm,date)) > max(os.path.getmtime(filename) for filename in inputs)):
+    status='up to date'
+  else:
+    try:
+      do_TC_plot(storm,date)
+      status='plotted'
+    except Exception as exc:
+      print 'Failed '+storm+'_'+date+': '+str(exc)
+      plt.close('all')
+      status='failed'
+
+  return storm,date,status,time.time()-start
+
+# print_timing
+#
+# Prints the time taken by every figure and in total
+###########################################################
+
+def print_timing(results,total):
+
+  print '%-10s %-9s %-11s %8s' % ('Storm','Date','Status','Seconds')
+  for storm,date,status,seconds in results:
+    print '%-10s %-9s %-11s %8.2f' % (storm,date,status,seconds)
+  plotted=len([result for result in results if result[2] == 'plotted'])
+  failed=len([result for result in results if result[2] == 'failed'])
+  print '%d figures, %d plotted, %d failed in %.2f s' % (len(results),plotted,failed,total)
+
+# track_file
+#
+# Returns the MOTC track file of the job for the storm and date
+###########################################################
+
+def track_file(storm,date,job_tag):
+
+  if job_tag=='OBS':
+    return '../MOTC_output/'+job_tag+'_'+storm
+  else:
+    return '../MOTC_output/'+job_tag+'_'+date+'_'+storm
+
+# plot_file
+#
+# Returns the plot of the storm and date
+###########################################################
+
+def plot_file(storm,date):
+
+  return '../plots/'+storm+'_'+date+'.png'
+
+###########################################################
+
+def do_TC_plot(storm,date):
 
   # Set up plot
   fig = plt.figure(figsize=(14,6))
   #plt.suptitle(storm+' '+date,fontsize=20)
   # Plot trajectory
   plt.subplot(1,2,1, projection=cartopy.crs.PlateCarree())
-  plot_traj(date)
+  plot_traj(storm,date)
 
   # Plot PMSL
   ax = plt.subplot(2,2,2)
-  plot_pmsl(ax,date)
+  plot_pmsl(ax,storm,date)
 
   #Plot WIND SPEED
   ax = plt.subplot(2,2,4)
-  plot_winds(ax,date)
+  plot_winds(ax,storm,date)
 
   #Save plot
   plot_name=storm+'_'+date
-  plt.savefig('../plots/'+plot_name+'.png')
+  plt.savefig(plot_file(storm,date))
   print 'Saved '+plot_name+'.png'
   plt.close()
 
@@ -69,12 +212,12 @@ def do_TC_plot(date):
 # trajectory of the cyclone
 ###########################################################
 
-def plot_traj(date):
+def plot_traj(storm,date):
 
  #Iterate through jobs
  for j,job in enumerate(jobs):
    print '-------- plot_traj '+job+' '+date
-   time,lat,lon,pmsl,spd=read_in_tracks(date,job)
+   time,lat,lon,pmsl,spd=read_in_tracks(storm,date,job)
 
    #Plot track
    plt.plot(lon,lat,c=jobs[job][1],marker=jobs[job][4],lw=jobs[job][2],ls=jobs[job][3],markersize=4)
@@ -113,11 +256,11 @@ def plot_traj(date):
 # intensity of the cyclone
 ###########################################################
 
-def plot_pmsl(ax,date):
+def plot_pmsl(ax,storm,date):
 
   #Iterate through jobs
   for j,job in enumerate(sorted(jobs)):
-    time,lat,lon,pmsl,spd=read_in_tracks(date,job)
+    time,lat,lon,pmsl,spd=read_in_tracks(storm,date,job)
 
     # Set tag. include day for fcst
     if job == 'OBS':
@@ -143,11 +286,11 @@ def plot_pmsl(ax,date):
 # cyclone
 ###########################################################
 
-def plot_winds(ax,date):
+def plot_winds(ax,storm,date):
 
   #Iterate through jobs
   for j,job in enumerate(sorted(jobs)):
-    time,lat,lon,pmsl,spd=read_in_tracks(date,job)
+    time,lat,lon,pmsl,spd=read_in_tracks(storm,date,job)
     #Plot Int
     label_tag=jobs[job][0]+' '+datetime.datetime.strptime(date,'%Y%m%d').strftime('%d')
     #Only plot Sarika ones
@@ -182,41 +325,47 @@ def get_box(lat,lon):
 # for the exp
 ###########################################################
 
-def read_in_tracks(date,job_tag):
-  #Define arrays
-  time_all=[]
-  lat_all=[]
-  lon_all=[]
-  pmsl_all=[]
-  spd_all=[]
+def read_in_tracks(storm,date,job_tag):
   #Read in data
   if job_tag=='OBS':
-    f=open('../MOTC_output/'+job_tag+'_'+storm,'r')
+    track=cached_track(track_file(storm,date,job_tag),job_tag,None,storm)
+  else:
+    track=cached_track(track_file(storm,date,job_tag),job_tag,date,storm)
+
+  #Keep the days to pick, those of the OBS track if not set for the storm
+  if storm in storm_days:
+    first=datetime.datetime.strptime(storm_days[storm][0],'%d/%m/%Y')
+    last=datetime.datetime.strptime(storm_days[storm][1],'%d/%m/%Y')
+  else:
+    obs=cached_track(track_file(storm,date,'OBS'),'OBS',None,storm)
+    if len(obs) == 0:
+      raise ValueError('No observed track of '+storm)
+    first=obs['time'].min()
+    last=obs['time'].max()
+  track=tracks.select_times(track,first,last)
+
+  return track['time'].astype(object),track['lat'],track['lon'],track['pmsl'],track['wind']
+
+# cached_track
+#
+# Returns the track of the file from the tracks already read
+# if it has not changed since, otherwise reads it
+###########################################################
+
+def cached_track(filename,job_tag,date,storm):
+
+  key=(job_tag,date,storm,os.path.getmtime(filename))
+  if key in track_cache:
+    #Most recently used last
+    track=track_cache.pop(key)
   else:
-    f=open('../MOTC_output/'+job_tag+'_'+date+'_'+storm,'r')
-
-  f.readline()
-  f.readline()
-  f.readline()
-
-
-  for i in f.readlines():
-    if i.split():
-      #Get time
-      time_str=' '.join(i.split()[0:2])
-      time_dt=datetime.datetime.strptime(time_str,'%H%MUTC %d.%m.%Y')
-      time_match=time_dt>=datetime.datetime.strptime(days_to_pick[0],'%d/%m/%Y') and time_dt<=datetime.datetime.strptime(days_to_pick[1],'%d/%m/%Y')
-      if time_match:
-#        print( date, job_tag,time_dt)
-        lat_all.append(float(i.split()[3][:-1]))
-        lon_all.append(float(i.split()[4][:-1]))
-        pmsl_all.append(float(i.split()[5]))
-        spd_all.append(float(i.split()[6]))
-        time_all.append(time_dt)
-
-  f.close()
-
-  return time_all,lat_all,lon_all,pmsl_all,spd_all
+    track=tracks.read_motc(filename)
+  track_cache[key]=track
+
+  while len(track_cache) > track_cache_size:
+    track_cache.popitem(last=False)
+
+  return track
 
 #                     END OF PROGRAM                                     #
 ##########################################################################
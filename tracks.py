@@ -0,0 +1,104 @@
+import numpy as np
+
+##########################################################################
+#                           TRACKS                                       #
+#                                                                        #
+# Tracks of tropical cyclones as structured NumPy arrays, one row per    #
+# point, to read and plot them (plot_Int_traj.py). Reads the             #
+# glm_cpl_<init>_<STORM> files of output_models.py, which writes the     #
+# strings of the database as they are, and the MOTC files (the same      #
+# columns after 3 header lines):                                         #
+#    1200UTC 09.08.2019   12  27.3N 122.0E      945            70        #
+# Works with python 2 and 3.                                             #
+##########################################################################
+
+TRACK_DTYPE=np.dtype([('time','datetime64[m]'),
+                      ('lead','i2'),
+                      ('lat','f4'),
+                      ('lon','f4'),
+                      ('pmsl','f4'),
+                      ('wind','f4')])
+
+# Header lines of the MOTC files
+MOTC_HEADER=3
+
+# make_track
+#
+# Returns a track from columns of strings as in the files: times as
+# 'YYYYmmddHH' (or anything numpy.datetime64 takes), lead times in hours,
+# latitudes ending in N/S, longitudes in E/W, pmsl and wind speed
+###########################################################
+
+def make_track(times,lead,lat,lon,pmsl,wind):
+
+  track=np.zeros(len(times),dtype=TRACK_DTYPE)
+  if len(times) == 0:
+    return track
+
+  times=np.asarray(times)
+  if times.dtype.kind in 'SU':
+    times=np.array([t[0:4]+'-'+t[4:6]+'-'+t[6:8]+'T'+t[8:10] for t in times.astype(str)])
+  track['time']=times.astype('datetime64[m]')
+  track['lead']=np.asarray(lead).astype('i2')
+  track['lat']=hemisphere_to_float(lat,'S')
+  track['lon']=hemisphere_to_float(lon,'W')
+  track['pmsl']=np.asarray(pmsl).astype('f4')
+  track['wind']=np.asarray(wind).astype('f4')
+
+  return track
+
+# hemisphere_to_float
+#
+# Converts coordinates ending in their hemisphere (27.3N, 122.0E) to
+# floats, negative in the negative hemisphere
+###########################################################
+
+def hemisphere_to_float(values,negative):
+
+  values=np.asarray(values).astype(str)
+  sign=np.where(np.char.endswith(values,negative),-1.,1.)
+
+  return (sign*np.char.rstrip(values,'NSEW').astype('f4')).astype('f4')
+
+# read_track
+#
+# Reads a glm_cpl or MOTC file (header=MOTC_HEADER) into a track
+###########################################################
+
+def read_track(filename,header=0):
+
+  f=open(filename,'r')
+  for h in range(header):
+    f.readline()
+  rows=[i.split() for i in f if i.strip()]
+  f.close()
+
+  if not rows:
+    return np.zeros(0,dtype=TRACK_DTYPE)
+
+  columns=np.array(rows)
+  # 1200UTC 09.08.2019 to 2019-08-09T12:00
+  times=np.array([d[6:10]+'-'+d[3:5]+'-'+d[0:2]+'T'+t[0:2]+':'+t[2:4]
+                  for t,d in zip(columns[:,0],columns[:,1])],dtype='datetime64[m]')
+
+  return make_track(times,columns[:,2],columns[:,3],columns[:,4],columns[:,5],columns[:,6])
+
+# read_motc
+#
+# Reads the track of a MOTC file
+###########################################################
+
+def read_motc(filename):
+
+  return read_track(filename,MOTC_HEADER)
+
+# select_times
+#
+# Returns the points of the track with first <= time <= last, datetimes
+###########################################################
+
+def select_times(track,first,last):
+
+  keep=(track['time'] >= np.datetime64(first,'m')) & (track['time'] <= np.datetime64(last,'m'))
+
+  return track[keep]